@@ -3,15 +3,24 @@ from src.algorithms.BaseKeypointAlgorithm import BaseKeypointAlgorithm
 from timeit import default_timer as timer
 
 class BRIEF(BaseKeypointAlgorithm):
-    def __init__(self, parts, images, topMatches=20, drawMatches=True, iteration=None):
-        super().__init__(parts, images, topMatches, drawMatches, iteration)
-        self.bf = cv.BFMatcher(cv.NORM_HAMMING, crossCheck=True)
+    def __init__(self, parts, images, topMatches=20, drawMatches=True, iteration=None, workers=1, threads=1, descriptorCache=None,
+                 indexedMatching=False, indexNeighbours=10, prefilterImages=None, vocabularySize=500, popcountMatching=False,
+                 stackedMatching=False, acceptDistance=None, acceptRatio=None, partKeypointBudget=None,
+                 imageKeypointBudget=None, keypointGrid=None, lazyImages=False):
+        super().__init__(parts, images, topMatches, drawMatches, iteration, workers, threads, descriptorCache,
+                         indexedMatching, indexNeighbours, prefilterImages, vocabularySize, popcountMatching, stackedMatching,
+                         acceptDistance, acceptRatio, partKeypointBudget, imageKeypointBudget, keypointGrid, lazyImages)
+        self.normType = cv.NORM_HAMMING
+        self.bf = cv.BFMatcher(self.normType, crossCheck=True)
+        self.createDetectors()
+
+    def createDetectors(self):
         self.fast = cv.FastFeatureDetector_create()
         self.brief = cv.xfeatures2d.BriefDescriptorExtractor_create()
 
-    def calculateDescriptor(self, img):
+    def calculateDescriptor(self, img, budget=None):
         t = timer()
-        kp = self.fast.detect(img, None)
+        kp = self.retainKeypoints(self.fast.detect(img, None), img.shape, budget)
         keypoints, descriptors = self.brief.compute(img, kp)
         t = timer() - t
 
@@ -2,40 +2,214 @@ from typing import List
 from types import LambdaType
 
 import cv2 as cv
+import copy
+import csv
+import json
 import os
+import threading
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from multiprocessing import Pool
 from timeit import default_timer as timer
+from src.algorithms.DescriptorCache import DescriptorCache
+from src.algorithms.DescriptorStore import DescriptorStore
+from src.algorithms.ResultWriter import ResultWriter, writeImage
+
+# OpenCV flags for decoding images straight to reduced grayscale, by reduction factor
+REDUCED_GRAYSCALE_FLAGS = {2: cv.IMREAD_REDUCED_GRAYSCALE_2, 4: cv.IMREAD_REDUCED_GRAYSCALE_4, 8: cv.IMREAD_REDUCED_GRAYSCALE_8}
 
 class InputImage:
-    def __init__(self, image: np.ndarray, path: str = "") -> None:
+    def __init__(self, image: np.ndarray, path: str = "", grayImage: np.ndarray = None, fromFile: bool = False) -> None:
+        # color image may be None, if the image was loaded in grayscale only (see loadImages())
         self.colorImage = image
+        # if the pixels were decoded from the file at path by a loader - only then they can be loaded from it again
+        # (see canReload()), other images may hold modified pixels
+        self.fromFile = fromFile
+        # if the file is decoded in color when the pixels have to be loaded from it again
+        self.color = image is not None
+        self.grayImage = grayImage
+        # grayscale images with reduced resolution, by reduction factor (see getGrayImage())
+        self.reducedImages = {}
         if path == "":
             self.filePath = "<in memory image>"
         else:
             self.filePath = path
 
+    def getGrayImage(self, reduction: int = 1) -> np.ndarray:
+        """
+        Returns the grayscale image, converted from the color one on first use
+
+        :param reduction: 2, 4 or 8 returns the image with its resolution reduced this many times - the pixels held
+                          are downscaled (see LazyInputImage for decoding straight to the reduced resolution)
+        """
+        if reduction != 1:
+            if reduction not in self.reducedImages:
+                gray = self.getGrayImage()
+                size = (-(-gray.shape[1] // reduction), -(-gray.shape[0] // reduction))
+                self.reducedImages[reduction] = cv.resize(gray, size, interpolation=cv.INTER_AREA)
+            return self.reducedImages[reduction]
+        if self.grayImage is None:
+            if self.colorImage is None and self.canReload():
+                # pixels were dropped by release(), they are decoded the same way the loader did it
+                if self.color:
+                    self.grayImage = cv.cvtColor(cv.imread(self.filePath), cv.COLOR_BGR2GRAY)
+                else:
+                    self.grayImage = cv.imread(self.filePath, cv.IMREAD_GRAYSCALE)
+            else:
+                self.grayImage = cv.cvtColor(self.colorImage, cv.COLOR_BGR2GRAY)
+        return self.grayImage
+
+    def canReload(self) -> bool:
+        """
+        If the pixels were decoded from the file of the image and can be loaded from it again
+        """
+        return self.fromFile and os.path.isfile(self.filePath)
+
+    def release(self, lazy: bool = False):
+        """
+        Called once the algorithm doesn't need the pixels anymore - grayscale images are dropped if they can be
+        converted from the color image again, the color image is kept, except in lazy mode (see BaseAlgorithm.lazyImages),
+        where images that can be loaded again drop all pixels
+
+        :param lazy: If the algorithm uses lazy mode
+        """
+        if lazy and self.canReload():
+            self.colorImage = None
+            self.grayImage = None
+            self.reducedImages = {}
+        elif self.colorImage is not None:
+            self.grayImage = None
+            self.reducedImages = {}
+
+class LazyInputImage(InputImage):
+    def __init__(self, path: str, color: bool = True) -> None:
+        """
+        Image decoded from its file on first access, its pixels are dropped again by release()
+
+        :param color: If the color image should be decoded, otherwise the file is decoded straight to grayscale
+                      and colorImage is None
+        """
+        super().__init__(None, os.path.abspath(path), fromFile=True)
+        self.color = color
+
+    @property
+    def colorImage(self):
+        if self.loadedColorImage is None and self.color:
+            self.loadedColorImage = cv.imread(self.filePath)
+        return self.loadedColorImage
+
+    @colorImage.setter
+    def colorImage(self, image):
+        self.loadedColorImage = image
+
+    def getGrayImage(self, reduction: int = 1) -> np.ndarray:
+        if reduction != 1 and reduction not in self.reducedImages:
+            # the file isn't decoded at full resolution at all, reduced decoding is cheaper
+            self.reducedImages[reduction] = cv.imread(self.filePath, REDUCED_GRAYSCALE_FLAGS[reduction])
+        if reduction == 1 and self.grayImage is None and not self.color:
+            self.grayImage = cv.imread(self.filePath, cv.IMREAD_GRAYSCALE)
+        return super().getGrayImage(reduction)
+
+    def release(self, lazy: bool = False):
+        self.loadedColorImage = None
+        self.grayImage = None
+        self.reducedImages = {}
+
+# decodes image files in a pool of threads (OpenCV releases the GIL while decoding), keeps their order
+# with color=False, images are decoded straight to grayscale and the color image isn't kept -
+# results can still be written, color images are loaded again from the files (see BaseAlgorithm.getResultImages())
+def loadImages(filePaths, threads=None, color=True) -> List[InputImage]:
+    def load(filePath):
+        if color:
+            return InputImage(cv.imread(filePath), filePath, fromFile=True)
+        return InputImage(None, filePath, cv.imread(filePath, cv.IMREAD_GRAYSCALE), fromFile=True)
+
+    with ThreadPoolExecutor(threads) as executor:
+        return list(executor.map(load, filePaths))
+
 # loads every image in a directory - absolute or relative
 # fromDirectory("directory")
 # doesn't check for file types etc.
-def fromDirectory(path) -> List[InputImage]:
+def fromDirectory(path, threads=None, color=True) -> List[InputImage]:
     absolute = os.path.abspath(path)
-    result = []
-    for fileName in os.listdir(absolute):
-        filePath = os.path.abspath(f"{absolute}/{fileName}")
-        result.append(InputImage(cv.imread(filePath), filePath))
-    return result
+    filePaths = [os.path.abspath(f"{absolute}/{fileName}") for fileName in os.listdir(absolute)]
+    return loadImages(filePaths, threads, color)
 
 # loads images from file paths - absolute or relative
 # fromFiles("path1", "path2", ...)
 # doesn't check for file types etc.
-def fromFiles(*files) -> List[InputImage]:
-    result = []
+def fromFiles(*files, threads=None, color=True) -> List[InputImage]:
+    filePaths = [os.path.abspath(file) for file in files]
+    return loadImages([filePath for filePath in filePaths if os.path.isfile(filePath)], threads, color)
+
+# lazily loads every image in a directory - nothing is decoded until the algorithm needs the pixels
+# (see LazyInputImage), the generator can be passed to algorithms instead of a list
+def streamDirectory(path, color=True):
+    absolute = os.path.abspath(path)
+    for fileName in os.listdir(absolute):
+        yield LazyInputImage(f"{absolute}/{fileName}", color)
+
+# lazily loads images from file paths, same as streamDirectory()
+def streamFiles(*files, color=True):
     for file in files:
-        absolute = os.path.abspath(file)
-        if not os.path.isfile(absolute):
-            continue
-        result.append(InputImage(cv.imread(absolute), absolute))
+        if os.path.isfile(file):
+            yield LazyInputImage(file, color)
+
+# decodes every image in a directory once and stores the pixels in a single archive file (see DescriptorStore),
+# its index with paths of the images is written next to it into archivePath.json - load it with fromArchive()
+# with color=False, only grayscale images are stored (same as loadImages() with color=False)
+# packDirectory("directory", "archive.bin")
+def packDirectory(path, archivePath, color=True):
+    store = DescriptorStore(archivePath)
+    store.reset()
+    paths = []
+    # images are decoded one at a time, so the whole directory never has to fit into memory
+    for image in streamDirectory(path, color):
+        store.add(image.colorImage if color else image.getGrayImage())
+        paths.append(image.filePath)
+        image.release()
+    store.open()
+    with open(f"{store.path}.json", "w") as file:
+        json.dump({"color": color, "paths": paths, "stats": [getFileStat(filePath) for filePath in paths], "index": store.index}, file)
+
+# checks if an archive from packDirectory() exists and the directory still contains the same files (by their sizes and
+# modification times), so it doesn't have to be packed again
+def isArchiveCurrent(archivePath, path, color=True) -> bool:
+    indexPath = f"{os.path.abspath(archivePath)}.json"
+    if not os.path.isfile(indexPath) or not os.path.isfile(os.path.abspath(archivePath)):
+        return False
+    with open(indexPath, "r") as file:
+        archive = json.load(file)
+    if archive["color"] != color or "stats" not in archive:
+        return False
+    absolute = os.path.abspath(path)
+    current = {os.path.abspath(f"{absolute}/{fileName}") for fileName in os.listdir(absolute)}
+    if current != set(archive["paths"]):
+        return False
+    return all(getFileStat(filePath) == stat for filePath, stat in zip(archive["paths"], archive["stats"]))
+
+# size and modification time of a file, used to detect changed files (see isArchiveCurrent())
+def getFileStat(filePath):
+    stat = os.stat(filePath)
+    return [stat.st_size, stat.st_mtime_ns]
+
+# loads images packed by packDirectory() - pixels are memory-mapped from the archive, nothing is decoded
+# and only the pages actually used are read from the disk
+def fromArchive(archivePath) -> List[InputImage]:
+    store = DescriptorStore(archivePath)
+    with open(f"{store.path}.json", "r") as file:
+        archive = json.load(file)
+    store.index = [(offset, tuple(shape), dtype) for offset, shape, dtype in archive["index"]]
+    if len(store.index) == 0:
+        return []
+    result = []
+    for arrayId, filePath in enumerate(archive["paths"]):
+        pixels = store.get(arrayId)
+        if archive["color"]:
+            result.append(InputImage(pixels, filePath, fromFile=True))
+        else:
+            result.append(InputImage(None, filePath, pixels, fromFile=True))
     return result
 
 # loads in-memory images - OpenCV's imread etc.
@@ -45,6 +219,36 @@ def fromImages(*images) -> List[InputImage]:
         result.append(InputImage(image))
     return result
 
+# keypoints are kept as structured arrays instead of lists of cv.KeyPoint (converted back only for drawing),
+# fields have the same types as in cv.KeyPoint (see BaseKeypointAlgorithm.keypointsToArray())
+KEYPOINT_DTYPE = np.dtype([("x", np.float32), ("y", np.float32), ("size", np.float32), ("angle", np.float32),
+                           ("response", np.float32), ("octave", np.int32), ("classId", np.int32)])
+
+# columns of match records written into CSV files (see BaseAlgorithm.writeRecords())
+RECORD_CSV_COLUMNS = ("partPath", "imagePath", "startX", "startY", "endX", "endY", "distance", "topMatches",
+                      "partKeypoints", "imageKeypoints")
+# keypoint fields kept in match records, enough for drawing the matches
+RECORD_KEYPOINT_FIELDS = ("x", "y", "size", "angle")
+
+# least number of scanned images needed for stopping early based on acceptRatio (see BaseAlgorithm.isConfident())
+ACCEPT_RATIO_MIN_IMAGES = 5
+
+# algorithm instance in a worker process of the matching pool (see BaseAlgorithm.createPool())
+_workerAlgorithm = None
+
+def _initWorker(algorithm, imageData):
+    global _workerAlgorithm
+    _workerAlgorithm = algorithm
+    _workerAlgorithm.setWorkerData(imageData)
+
+def _matchInWorker(args):
+    partData, indices = args
+    # diagnostics collected during matching are sent back together with the matches
+    _workerAlgorithm.diagnostics = BaseAlgorithm.Diagnostics()
+    busyTime = timer()
+    matches = _workerAlgorithm.matchImages(partData, indices)
+    return matches, timer() - busyTime, _workerAlgorithm.diagnostics
+
 class BaseAlgorithm:
     class Diagnostics:
         class DiagnosticTimes:
@@ -54,18 +258,38 @@ class BaseAlgorithm:
                 self.individualImageMatching = []
                 self.allImagesMatching = []
                 self.partProcess = []
+                # time each worker process spent matching a part with its chunk of images (only when using workers)
+                self.workerMatching = []
+                # time it took to find and load cached descriptors of an image (only for cache hits)
+                self.cacheLoad = []
+                # time it took to encode a result image (without writing it into a file, see writeSingleResult())
+                self.resultEncoding = []
 
         class DiagnosticCounts:
             def __init__(self):
                 self.partDescriptorSize = []
                 self.imageDescriptorSize = []
                 self.subsets = []
+                # fraction of subsets abandoned before being evaluated completely, for each part-image pair
+                self.abandonedSubsets = []
+                # 1 if descriptors of an image were loaded from the descriptor cache, 0 if they had to be calculated
+                self.cacheHits = []
+                # number of images a part was matched with (fewer than all of them when stopping early)
+                self.scannedImages = []
 
         def __init__(self):
             self.times = self.DiagnosticTimes()
             self.counts = self.DiagnosticCounts()
             self.totalTime = -1
 
+        def merge(self, other):
+            """
+            Appends all measured values from other diagnostics (e.g. from a worker process)
+            """
+            for mine, theirs in ((self.times, other.times), (self.counts, other.counts)):
+                for name, values in vars(theirs).items():
+                    getattr(mine, name).extend(values)
+
     class AverageType(Enum):
         TIME = 1
         COUNT = 2
@@ -76,11 +300,12 @@ class BaseAlgorithm:
                      image: np.ndarray,
                      start: (int, int),
                      end: (int, int),
-                     partKeypoints: List[cv.KeyPoint] = None,
-                     imageKeypoints: List[cv.KeyPoint] = None,
+                     partKeypoints: np.ndarray = None,
+                     imageKeypoints: np.ndarray = None,
                      topMatches: List[cv.DMatch] = None,
                      partPath: str = None,
-                     imagePath: str = None) -> None:
+                     imagePath: str = None,
+                     distance: float = None) -> None:
             self.part = part
             self.image = image
             # rectangle for where the match was found
@@ -88,24 +313,63 @@ class BaseAlgorithm:
             self.end = end
             self.partPath = partPath
             self.imagePath = imagePath
-            # following variables are used in keypoint-based algorithms
+            # distance of the part and the matched image (lower is better)
+            self.distance = distance
+            # following variables are used in keypoint-based algorithms (keypoints are structured arrays,
+            # see BaseKeypointAlgorithm.keypointsToArray())
             self.partKeypoints = partKeypoints
             self.imageKeypoints = imageKeypoints
             self.topMatches = topMatches
 
-    def __init__(self, parts: List[InputImage], images: List[InputImage], iteration: int = None) -> None:
+    def __init__(self, parts: List[InputImage], images: List[InputImage], iteration: int = None, workers: int = 1,
+                 threads: int = 1, descriptorCache: DescriptorCache = None, acceptDistance: float = None,
+                 acceptRatio: float = None, lazyImages: bool = False) -> None:
         """
         Initializes the base matching algorithm
 
-        :param parts: Images that are being matched ("parts")
-        :param images: Image database to match into
+        :param parts: Images that are being matched ("parts"), any iterable (e.g. streamDirectory())
+        :param images: Image database to match into, any iterable
+        :param workers: Number of worker processes matching a part with the images in parallel (1 = no worker processes)
+        :param threads: Number of threads calculating descriptors of the images in processImages() (1 = no threads)
+        :param descriptorCache: Cache for descriptors of the images, consulted before calculating them in processImages()
+        :param acceptDistance: Images stop being scanned for a part once a match at most this distance is found
+        :param acceptRatio: Images stop being scanned for a part once the best distance is at most this fraction
+                            of the median distance of images scanned so far (see isConfident())
+        :param lazyImages: If color images loaded from files shouldn't be kept in imageData and results, they are
+                           loaded again when writing results (see getResultImages())
         """
-        self.parts = parts
-        self.images = images
+        # lazily loaded images don't hold any pixels yet, so they can be kept in lists
+        self.parts = list(parts)
+        self.images = list(images)
         self.diagnostics = self.Diagnostics()
         self.imageData = []
         self.results: List[BaseAlgorithm.MatchingResult] = []
         self.iteration = iteration
+        self.workers = workers
+        self.pool: Pool = None
+        self.threads = threads
+        self.descriptorCache = descriptorCache
+        self.acceptDistance = acceptDistance
+        self.acceptRatio = acceptRatio
+        # indices of matched images, the most recent first - scanned first when stopping early (see getScanOrder())
+        self.recentImages = []
+        self.lazyImages = lazyImages
+
+    def __getstate__(self):
+        # only the configuration is sent to worker processes, they get the data they need in createPool()
+        state = dict(self.__dict__)
+        for name in ("parts", "images", "imageData", "results", "diagnostics", "pool"):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.parts = []
+        self.images = []
+        self.imageData = []
+        self.results = []
+        self.diagnostics = self.Diagnostics()
+        self.pool = None
 
     def process(self) -> List[MatchingResult]:
         # overall structure of the algorithms stays the same
@@ -114,10 +378,171 @@ class BaseAlgorithm:
         # (optional) 3) use results - write them into files, print diagnostic data etc.
         self.diagnostics.totalTime = timer()
         self.processImages()
-        self.processParts()
+        if self.usesWorkers():
+            with self.createPool() as self.pool:
+                self.processParts()
+            self.pool = None
+        else:
+            self.processParts()
         self.diagnostics.totalTime = np.round((timer() - self.diagnostics.totalTime) * 1000, 3)
         return self.results
 
+    def mapInThreads(self, function, items):
+        """
+        Calls function(algorithm, item) for every item, in a pool of threads if enabled - every thread uses its own copy
+        of this algorithm (configuration only, see __getstate__()) with its own detectors (see createDetectors()),
+        since OpenCV detectors can't be shared between threads
+
+        :return: Generator of results in the same order as items
+        """
+        if self.threads <= 1:
+            for item in items:
+                yield function(self, item)
+            return
+
+        local = threading.local()
+        copies = []
+
+        def call(item):
+            if not hasattr(local, "algorithm"):
+                local.algorithm = copy.copy(self)
+                local.algorithm.createDetectors()
+                copies.append(local.algorithm)
+            return function(local.algorithm, item)
+
+        with ThreadPoolExecutor(self.threads) as executor:
+            yield from executor.map(call, items)
+        # diagnostics collected by the copies
+        for algorithm in copies:
+            self.diagnostics.merge(algorithm.diagnostics)
+
+    def loadFromCache(self, image, params):
+        """
+        Looks up cached descriptors of an image, records the hit or miss in diagnostics
+
+        :param image: InputImage
+        :param params: Parameters of the algorithm the descriptors depend on (see DescriptorCache.getKey())
+        :return: Tuple (key, arrays, time) - arrays are None on a miss, key is None if no cache is used,
+                 time it took to find and load the arrays
+        """
+        if self.descriptorCache is None:
+            return None, None, 0
+        loadTime = timer()
+        # descriptors are calculated from the grayscale image
+        key = self.descriptorCache.getKey(self.getGrayImage(image), params)
+        arrays = self.descriptorCache.load(key)
+        loadTime = timer() - loadTime
+        self.diagnostics.counts.cacheHits.append(0 if arrays is None else 1)
+        if arrays is not None:
+            self.diagnostics.times.cacheLoad.append(loadTime)
+        return key, arrays, loadTime
+
+    def stopsEarly(self):
+        """
+        If scanning images for a part may stop once a confident match is found (see isConfident())
+        """
+        return self.acceptDistance is not None or self.acceptRatio is not None
+
+    def getScanOrder(self, indices):
+        """
+        Returns the order in which images at given indices are matched with a part - when stopping early,
+        the most recently matched images go first, the rest keeps its order
+        """
+        indices = list(indices)
+        if not self.stopsEarly():
+            return indices
+        candidates = set(indices)
+        recent = [j for j in self.recentImages if j in candidates]
+        recentSet = set(recent)
+        return recent + [j for j in indices if j not in recentSet]
+
+    def isConfident(self, bestDistance, distances):
+        """
+        Checks if the best match of a part found so far is good enough to stop scanning the remaining images
+
+        :param bestDistance: Distance of the best match so far
+        :param distances: Distances of all images scanned so far (infinite ones are ignored)
+        """
+        if self.acceptDistance is not None and bestDistance <= self.acceptDistance:
+            return True
+        if self.acceptRatio is not None:
+            distances = np.asarray(distances, dtype=np.float64)
+            distances = distances[np.isfinite(distances)]
+            # the median isn't meaningful for just a few images
+            if len(distances) >= ACCEPT_RATIO_MIN_IMAGES and bestDistance <= self.acceptRatio * np.median(distances):
+                return True
+        return False
+
+    def addRecentImage(self, index):
+        """
+        Marks image at given index as the most recently matched one
+        """
+        if index in self.recentImages:
+            self.recentImages.remove(index)
+        self.recentImages.insert(0, index)
+
+    def getGrayImage(self, image: InputImage) -> np.ndarray:
+        """
+        Returns the grayscale image descriptors of given part or image are calculated from
+        """
+        return image.getGrayImage()
+
+    def retainImage(self, image: InputImage):
+        """
+        Returns the color image to keep in imageData or results - None in lazy mode or for lazily loaded images,
+        if it was decoded from its file and can be loaded from it again (other in-memory images are always kept)
+        """
+        if (self.lazyImages or isinstance(image, LazyInputImage)) and image.canReload():
+            return None
+        return image.colorImage
+
+    @staticmethod
+    def getResultImages(result):
+        """
+        Returns color images of the part and image of a result, loading the ones not kept in memory from their files
+
+        :return: Tuple (part, image)
+        """
+        part = result.part if result.part is not None else cv.imread(result.partPath)
+        image = result.image if result.image is not None else cv.imread(result.imagePath)
+        return part, image
+
+    def usesWorkers(self):
+        """
+        If processParts() matches parts in worker processes, so the pool has to be created (see createPool()) -
+        child algorithms exclude matching paths that don't use it
+        """
+        return self.workers > 1
+
+    def createPool(self) -> Pool:
+        """
+        Creates a pool of worker processes, each one gets a copy of this algorithm (without images and results)
+        and the data needed for matching (see getWorkerData())
+
+        Depending on the platform, workers may be started by re-importing the main module,
+        so scripts using workers should be guarded with if __name__ == "__main__"
+        """
+        return Pool(self.workers, initializer=_initWorker, initargs=(self, self.getWorkerData()))
+
+    def matchImagesParallel(self, partData, indices=None):
+        """
+        Scatters matching of a part with all images across the worker pool, each worker gets a chunk of consecutive images
+
+        :param partData: Data describing the part, passed to matchImages()
+        :param indices: Indices of images in imageData to match with (all images if None)
+        :return: Results of matchImages() for all images, in the same order as imageData (or indices)
+        """
+        if indices is None:
+            indices = range(len(self.imageData))
+        bounds = np.linspace(0, len(indices), self.workers + 1).astype(int)
+        chunks = [indices[start:end] for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+        results = []
+        for matches, busyTime, diagnostics in self.pool.map(_matchInWorker, [(partData, chunk) for chunk in chunks]):
+            results.extend(matches)
+            self.diagnostics.merge(diagnostics)
+            self.diagnostics.times.workerMatching.append(busyTime)
+        return results
+
     # implement in child algorithms
 
     def processImages(self):
@@ -132,28 +557,182 @@ class BaseAlgorithm:
         """
         pass
 
-    def writeResults(self, target, includePart=False):
+    def getDescriptorParams(self):
+        """
+        Returns parameters the calculated descriptors depend on, used as a part of the descriptor cache key
+        """
+        pass
+
+    def createDetectors(self):
+        """
+        Creates OpenCV objects used for calculating descriptors (called again for every thread in mapInThreads())
+        """
+        pass
+
+    def getWorkerData(self):
+        """
+        Returns the part of imageData needed for matching in worker processes (must be picklable)
+        """
+        pass
+
+    def setWorkerData(self, imageData):
+        """
+        Sets imageData of the algorithm in a worker process from the result of getWorkerData()
+        """
+        self.imageData = imageData
+
+    def matchImages(self, partData, indices):
+        """
+        Matches a part with images at given indices of imageData
+
+        :param partData: Data describing the part (must be picklable)
+        :param indices: Indices of images in imageData
+        :return: List of results for each image (must be picklable)
+        """
+        pass
+
+    def writeResults(self, target, includePart=False, writer: ResultWriter = None):
         """
         Writes the match results into files
 
         :param target: Directory path (string) or a lambda that takes result index (int) and returns a path for the actual file
         :param includePart: Boolean, if the saved result should include the searched part or not
+        :param writer: (optional) ResultWriter writing the files in background threads, see writeSingleResult()
         """
         isLambda = isinstance(target, LambdaType)
         for i, result in enumerate(self.results):
             path = os.path.abspath(f"{target}/{i}.jpg") if not isLambda else os.path.abspath(target(i))
-            self.writeSingleResult(result, path, includePart)
+            self.writeSingleResult(result, path, includePart, writer)
 
-    def writeSingleResult(self, result, path, includePart=False):
+    def writeSingleResult(self, result, path, includePart=False, writer: ResultWriter = None):
         """
         Writes a single match result into a file
 
         :param result: Matching result (actual MatchingResult object)
         :param path: Path, where the result should be saved
         :param includePart: Boolean, if the saved result should include the searched part or not
+        :param writer: (optional) ResultWriter - the image is only rendered here and queued to be encoded and written
+                       in the background, files are complete after writer.flush() (or at exit)
+        """
+        path = os.path.abspath(path)
+        image = self.renderResult(result, includePart)
+        if writer is not None:
+            writer.write(path, image, self.diagnostics)
+        else:
+            self.diagnostics.times.resultEncoding.append(writeImage(path, image))
+
+    def renderResult(self, result, includePart=False) -> np.ndarray:
+        """
+        Draws a single match result into an image
+
+        :param result: Matching result (actual MatchingResult object)
+        :param includePart: Boolean, if the image should include the searched part or not
+        :return: Color image
         """
         pass
 
+    def writeRecords(self, path):
+        """
+        Writes the match results as records without rendering any images - JSON Lines or CSV, by the file extension
+        (.jsonl or .csv). Images can be rendered from the records later (see readRecords())
+
+        Each record contains partPath, imagePath, start and end of the rectangle, distance, topMatches (pairs of
+        queryIdx and trainIdx of keypoint matches, empty for other algorithms) and partKeypoints and imageKeypoints
+        ([x, y, size, angle] of the matched keypoints, in the order of topMatches). In CSV, coordinates are in columns
+        startX, startY, endX, endY, top matches are written as "queryIdx:trainIdx" and keypoints as "x:y:size:angle",
+        separated by spaces
+
+        :param path: Path of the file
+        """
+        records = [self.getRecord(result) for result in self.results]
+        with open(path, "w", newline="") as file:
+            if os.path.splitext(path)[1].lower() == ".csv":
+                writer = csv.writer(file)
+                writer.writerow(RECORD_CSV_COLUMNS)
+                for record in records:
+                    writer.writerow([record["partPath"], record["imagePath"], *record["start"], *record["end"], record["distance"],
+                                     " ".join(f"{queryIdx}:{trainIdx}" for queryIdx, trainIdx in record["topMatches"]),
+                                     " ".join(":".join(map(str, keypoint)) for keypoint in record["partKeypoints"]),
+                                     " ".join(":".join(map(str, keypoint)) for keypoint in record["imageKeypoints"])])
+            else:
+                for record in records:
+                    file.write(json.dumps(record) + "\n")
+
+    @staticmethod
+    def getRecord(result) -> dict:
+        """
+        Returns a match result as a record with plain types (see writeRecords())
+        """
+        topMatches = result.topMatches or []
+        getKeypoint = lambda keypoint: [float(keypoint[field]) for field in RECORD_KEYPOINT_FIELDS]
+        return {
+            "partPath": result.partPath,
+            "imagePath": result.imagePath,
+            "start": [int(result.start[0]), int(result.start[1])],
+            "end": [int(result.end[0]), int(result.end[1])],
+            "distance": None if result.distance is None else float(result.distance),
+            "topMatches": [[match.queryIdx, match.trainIdx] for match in topMatches],
+            "partKeypoints": [getKeypoint(result.partKeypoints[match.queryIdx]) for match in topMatches],
+            "imageKeypoints": [getKeypoint(result.imageKeypoints[match.trainIdx]) for match in topMatches]
+        }
+
+    @staticmethod
+    def readRecords(path) -> List[MatchingResult]:
+        """
+        Reads match results written by writeRecords() - they don't hold any images, those are loaded from the files
+        when a result is rendered, e.g. by writeSingleResult() of the algorithm that produced them.
+        Results only keep the matched keypoints, topMatches index them in the order of the record
+
+        :param path: Path of a .jsonl or .csv file
+        """
+        records = []
+        with open(path, "r", newline="") as file:
+            if os.path.splitext(path)[1].lower() == ".csv":
+                for row in csv.DictReader(file):
+                    records.append({
+                        "partPath": row["partPath"],
+                        "imagePath": row["imagePath"],
+                        "start": [int(row["startX"]), int(row["startY"])],
+                        "end": [int(row["endX"]), int(row["endY"])],
+                        "distance": float(row["distance"]) if row["distance"] != "" else None,
+                        "topMatches": [pair.split(":") for pair in row["topMatches"].split()],
+                        "partKeypoints": [keypoint.split(":") for keypoint in row["partKeypoints"].split()],
+                        "imageKeypoints": [keypoint.split(":") for keypoint in row["imageKeypoints"].split()]
+                    })
+            else:
+                records = [json.loads(line) for line in file if line.strip() != ""]
+
+        results = []
+        for record in records:
+            # distances of the matches aren't needed for drawing them
+            topMatches = [cv.DMatch(i, i, 0, 0) for i in range(len(record["topMatches"]))]
+            partKeypoints, imageKeypoints = None, None
+            if len(topMatches) > 0:
+                partKeypoints = BaseAlgorithm.keypointsFromRecord(record["partKeypoints"])
+                imageKeypoints = BaseAlgorithm.keypointsFromRecord(record["imageKeypoints"])
+            results.append(BaseAlgorithm.MatchingResult(part=None,
+                                                        image=None,
+                                                        start=tuple(record["start"]),
+                                                        end=tuple(record["end"]),
+                                                        partKeypoints=partKeypoints,
+                                                        imageKeypoints=imageKeypoints,
+                                                        topMatches=topMatches,
+                                                        partPath=record["partPath"],
+                                                        imagePath=record["imagePath"],
+                                                        distance=record["distance"]))
+        return results
+
+    @staticmethod
+    def keypointsFromRecord(keypoints) -> np.ndarray:
+        """
+        Converts keypoints of a match record ([x, y, size, angle] each) into a structured array (see KEYPOINT_DTYPE)
+        """
+        array = np.zeros(len(keypoints), dtype=KEYPOINT_DTYPE)
+        array["classId"] = -1
+        for i, field in enumerate(RECORD_KEYPOINT_FIELDS):
+            array[field] = [float(keypoint[i]) for keypoint in keypoints]
+        return array
+
     def printResults(self, filename=None):
         """
         Prints the measured results into file or in the console
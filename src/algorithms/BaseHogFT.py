@@ -1,100 +1,705 @@
 import cv2 as cv
 import numpy as np
-import os
+from numpy.lib.stride_tricks import as_strided
+from enum import Enum
+from math import ceil
 from time import strftime
 from src.algorithms.BaseAlgorithm import BaseAlgorithm
+from src.algorithms.DescriptorStore import DescriptorStore
 from timeit import default_timer as timer
 
 STEPS_PER_ITERATION = 50 * 75
 TOTAL_STEPS = STEPS_PER_ITERATION * 10
+# arrays of imageData (and its "coarse" part) moved into the descriptor store, if used
+STORED_ARRAYS = ("descriptor", "integral", "layout")
 
 class BaseHogFT(BaseAlgorithm):
-    def __init__(self, parts, images, iteration = None):
-        super().__init__(parts, images, iteration)
+    class MatchingMode(Enum):
+        LOOP = 1        # evaluates every subset separately in a Python loop
+        VECTORIZED = 2  # evaluates all subsets of an image at once (see calculateDistanceMap())
+        FFT = 3         # same as VECTORIZED, but the correlation of part and image is calculated using FFT
+        EARLY_ABANDON = 4   # same as LOOP, but stops evaluating a subset once it's worse than the best one so far
+
+    def __init__(self, parts, images, iteration = None, matchingMode=MatchingMode.LOOP, pyramidCandidates=5, batchParts=False,
+                 workers=1, threads=1, descriptorCache=None, descriptorStore=None, acceptDistance=None, acceptRatio=None,
+                 lazyImages=False, reduction=1):
+        super().__init__(parts, images, iteration, workers, threads, descriptorCache, acceptDistance, acceptRatio, lazyImages)
+        # how a part descriptor is matched with a single image descriptor
+        self.matchingMode = matchingMode
+        # coarse-to-fine search - child algorithms set "coarse" to the same algorithm with larger descriptor scale,
+        # best candidates found with it in each image are then refined at the fine scale (see matchImagePyramid())
+        self.coarse: BaseHogFT = None
+        self.pyramidCandidates = pyramidCandidates
+        # if all parts should be matched with one image before moving to the next one (see processPartsBatched())
+        # batched matching doesn't use worker processes
+        self.batchParts = batchParts
+        # if set, image descriptors (and integral images) are kept in this DescriptorStore instead of memory
+        self.descriptorStore: DescriptorStore = descriptorStore
+        # how many times the resolution of parts and images is reduced (1, 2, 4 or 8) before calculating descriptors -
+        # files are decoded with reduced decoding, resulting coordinates are scaled back (see getResultPointScale())
+        self.reduction = reduction
+        # ids of stored arrays of every imageData item (see resolveStoredArrays())
+        self.storedIds = []
 
     def processImages(self):
         print("---------")
-        for i, image in enumerate(self.images):
-            print(f"(Iteration {self.iteration + 1}, {strftime('%H:%M:%S')}) Preprocessing image {i + 1}")
+        if self.descriptorStore is not None:
+            self.descriptorStore.reset()
+        # descriptors may be calculated in multiple threads (see mapInThreads()), results are kept in order
+        for data, time in self.mapInThreads(lambda algorithm, item: algorithm.preprocessImage(*item), list(enumerate(self.images))):
+            self.diagnostics.times.imageDescriptor.append(time)
+            self.diagnostics.counts.imageDescriptorSize.append(data["descriptor"].size)
+            if self.descriptorStore is not None:
+                # arrays are written into the store file right away, replaced by their ids until it's mapped below
+                for container in (data, data.get("coarse", {})):
+                    for key in STORED_ARRAYS:
+                        if key in container:
+                            container[key] = self.descriptorStore.add(container[key])
+            self.imageData.append(data)
+
+        if self.descriptorStore is not None:
+            self.descriptorStore.open()
+            # ids are kept, worker processes get them instead of the arrays (see getWorkerData())
+            self.storedIds = [self.resolveStoredArrays(data) for data in self.imageData]
+
+    @staticmethod
+    def getStoredArrays(data):
+        """
+        Returns (container, key) pairs of arrays of an imageData item that are kept in the descriptor store
+        """
+        return [(container, key) for container in (data, data.get("coarse", {})) for key in STORED_ARRAYS if key in container]
+
+    def resolveStoredArrays(self, data):
+        """
+        Replaces ids of stored arrays in an imageData item by the arrays mapped from the descriptor store
+
+        :return: List of the ids, in the order of getStoredArrays()
+        """
+        ids = []
+        for container, key in self.getStoredArrays(data):
+            ids.append(container[key])
+            container[key] = self.descriptorStore.get(container[key])
+        return ids
+
+    def preprocessImage(self, i, image):
+        """
+        Calculates descriptors of a database image
+
+        :return: Tuple (data, time) - data is the item of imageData, time it took to calculate (or load) the descriptors
+        """
+        print(f"(Iteration {self.iteration + 1}, {strftime('%H:%M:%S')}) Preprocessing image {i + 1}")
+        key, cached, time = self.loadFromCache(image, self.getCacheParams())
+        if cached is not None:
+            descriptor = cached["descriptor"]
+            coarseDescriptor = cached.get("coarseDescriptor")
+        else:
             # convert image to gray, calculate descriptor for it (somehow)
-            img = cv.cvtColor(image.colorImage, cv.COLOR_BGR2GRAY)
+            img = self.getGrayImage(image)
             descriptor, time = self.calculateDescriptor(img)
+            arrays = {"descriptor": descriptor}
+            if self.coarse is not None:
+                coarseDescriptor, coarseTime = self.coarse.calculateDescriptor(img)
+                time = time + coarseTime
+                arrays["coarseDescriptor"] = coarseDescriptor
+            if key is not None:
+                self.descriptorCache.save(key, arrays)
 
-            self.diagnostics.times.imageDescriptor.append(time)
-            self.diagnostics.counts.imageDescriptorSize.append(descriptor.size)
-            # save the descriptor and image it belongs to
-            self.imageData.append({
-                "colorImage": image.colorImage,
-                "path": image.filePath,
-                "descriptor": descriptor
-            })
+        # save the descriptor and image it belongs to
+        data = {
+            "colorImage": self.retainImage(image),
+            "path": image.filePath,
+            "descriptor": descriptor
+        }
+        if self.matchingMode != self.MatchingMode.LOOP:
+            layout = self.toSubsetLayout(descriptor)
+            # squared descriptor values never change, so their sums over any subset can be looked up in all parts
+            # (only sums over all values of a point are needed, so the table is built from those)
+            data["integral"] = self.getIntegralImage(np.sum(layout ** 2, axis=2))
+            if self.descriptorStore is not None:
+                # the layout is read from the store as it is, instead of converting the mapped descriptor for every part
+                data["layout"] = layout
+        if self.coarse is not None:
+            # coarse search always uses the distance map, so it needs the integral image in every mode
+            # noinspection PyUnboundLocalVariable
+            coarseLayout = self.coarse.toSubsetLayout(coarseDescriptor)
+            data["coarse"] = {
+                "descriptor": coarseDescriptor,
+                "integral": self.getIntegralImage(np.sum(coarseLayout ** 2, axis=2))
+            }
+            if self.descriptorStore is not None:
+                data["coarse"]["layout"] = coarseLayout
+        # lazily loaded images drop their pixels, they aren't needed anymore
+        image.release(self.lazyImages)
+        return data, time
 
     def processParts(self):
+        if self.batchParts:
+            self.processPartsBatched()
+            return
+
         for i, part in enumerate(self.parts):
             print("---------")
             progress = self.iteration * STEPS_PER_ITERATION + i * 75
             print(f"(Iteration {self.iteration + 1}, {strftime('%H:%M:%S')}) Processing part {i + 1}/{len(self.parts)} ({(100 * (progress / TOTAL_STEPS)):.2f} %)")
             partProcessTime = timer()
             # convert part to gray, calculate descriptor for it
-            img = cv.cvtColor(part.colorImage, cv.COLOR_BGR2GRAY)
-            partSize = self.getSizeFromShape(img.shape)
-
-            partDescriptor, time = self.calculateDescriptor(img)
+            img = self.getGrayImage(part)
+            partSize = self.getPartSize(img)
 
-            self.diagnostics.times.partDescriptor.append(time)
-            self.diagnostics.counts.partDescriptorSize.append(partDescriptor.size)
+            partDescriptor, coarsePartDescriptor = self.calculatePartDescriptors(img)
+            part.release(self.lazyImages)
 
             # structure for storing the best result
-            best = {
-                "distance": float("inf"),  # default to +infinity
-                "colorImage": None,
-                "path": None,
-                "sX": -1,
-                "sY": -1,
-                "eX": -1,
-                "eY": -1
-            }
+            best = self.createBest()
 
             allImageProcessTime = timer()
-            for j, image in enumerate(self.imageData):
-                progress = self.iteration * STEPS_PER_ITERATION + i * 75 + j
-                print(f"- (Iteration {self.iteration + 1}, {strftime('%H:%M:%S')}) Pairing part {i + 1} with image {j + 1}/{len(self.imageData)} ({(100 * (progress / TOTAL_STEPS)):.2f} %)")
-                imageProcessTime = timer()
-                subsets = 0
-                # extract info about how subsets from the image should be gotten
-                windowSize, imageSize, stepSize = self.getSubsetParams(partDescriptor, image["descriptor"])
-                # iterate through all subsets from the image with the same size as the searched part
-                for startX, startY, endX, endY in self.getSubsets(windowSize, imageSize, stepSize):
-                    subsets = subsets + 1
-                    subset = self.getSubset(image["descriptor"], startX, startY, endX, endY)
-
-                    distance = np.linalg.norm(subset - partDescriptor)  # should calculate the euclidean distance
-
+            if self.pool is not None:
+                # matching is scattered across worker processes, measured times are the ones from the workers
+                matches = self.matchImagesParallel((partDescriptor, coarsePartDescriptor))
+                for image, (distance, startX, startY, subsets, time) in zip(self.imageData, matches):
+                    self.updateBest(best, image, partSize, distance, startX, startY)
+                    self.diagnostics.times.individualImageMatching.append(time)
+                    self.diagnostics.counts.subsets.append(subsets)
+                self.diagnostics.counts.scannedImages.append(len(self.imageData))
+            else:
+                # when stopping early, the most recently matched images go first (see getScanOrder())
+                scanned = []
+                bestIndex = None
+                for k, j in enumerate(self.getScanOrder(range(len(self.imageData)))):
+                    image = self.imageData[j]
+                    progress = self.iteration * STEPS_PER_ITERATION + i * 75 + k
+                    print(f"- (Iteration {self.iteration + 1}, {strftime('%H:%M:%S')}) Pairing part {i + 1} with image {j + 1}/{len(self.imageData)} ({(100 * (progress / TOTAL_STEPS)):.2f} %)")
+                    imageProcessTime = timer()
+                    # find the closest subset of this image, start is in descriptor coordinates
+                    if self.coarse is None:
+                        distance, startX, startY, subsets = self.matchImage(partDescriptor, image, best["distance"])
+                    else:
+                        distance, startX, startY, subsets = self.matchImagePyramid(partDescriptor, coarsePartDescriptor, image)
                     if distance < best["distance"]:
-                        # get "scale" which translates (x,y) pair from the descriptor point of view to pixel (x,y)
-                        scaleX, scaleY = self.getResultPointScale()
-                        best["distance"] = distance
-                        best["colorImage"] = image["colorImage"]
-                        best["path"] = image["path"]
-                        best["sX"] = startX * scaleX
-                        best["sY"] = startY * scaleY
-                        best["eX"] = best["sX"] + partSize[0]
-                        best["eY"] = best["sY"] + partSize[1]
-
-                self.diagnostics.times.individualImageMatching.append(timer() - imageProcessTime)
-                self.diagnostics.counts.subsets.append(subsets)
+                        bestIndex = j
+                    self.updateBest(best, image, partSize, distance, startX, startY)
+                    scanned.append(distance)
+
+                    self.diagnostics.times.individualImageMatching.append(timer() - imageProcessTime)
+                    self.diagnostics.counts.subsets.append(subsets)
+                    if self.stopsEarly() and self.isConfident(best["distance"], scanned):
+                        break
+                self.diagnostics.counts.scannedImages.append(len(scanned))
+                if bestIndex is not None:
+                    self.addRecentImage(bestIndex)
 
             end = timer()
             self.diagnostics.times.allImagesMatching.append(end - allImageProcessTime)
             self.diagnostics.times.partProcess.append(end - partProcessTime)
 
-            # noinspection PyTypeChecker
-            self.results.append(self.MatchingResult(part=part.colorImage,
-                                                    image=best["colorImage"],
-                                                    partPath=part.filePath,
-                                                    imagePath=best["path"],
-                                                    start=(best["sX"], best["sY"]),
-                                                    end=(best["eX"], best["eY"])))
+            self.appendResult(part, best)
+
+    def processPartsBatched(self):
+        """
+        Same as processParts(), but all parts are matched with one image before moving on to the next one -
+        image-side data is prepared once per image (see prepareImage()) and in vectorized modes parts with
+        the same descriptor shape are evaluated together (see calculateDistanceMaps()).
+        Matching time of such group is split evenly between its parts in diagnostics
+        """
+        print("---------")
+        parts = []
+        for part in self.parts:
+            partProcessTime = timer()
+            img = self.getGrayImage(part)
+            descriptor, coarseDescriptor = self.calculatePartDescriptors(img)
+            part.release(self.lazyImages)
+            parts.append({
+                "part": part,
+                "size": self.getPartSize(img),
+                "descriptor": descriptor,
+                "coarseDescriptor": coarseDescriptor,
+                "best": self.createBest(),
+                "descriptorTime": timer() - partProcessTime,
+                "matchingTime": 0
+            })
+
+        # group parts by descriptor shape, keeping their order
+        groups = {}
+        for part in parts:
+            groups.setdefault(part["descriptor"].shape, []).append(part)
+        vectorized = self.coarse is None and self.matchingMode in (self.MatchingMode.VECTORIZED, self.MatchingMode.FFT)
+
+        for j, image in enumerate(self.imageData):
+            print(f"- (Iteration {self.iteration + 1}, {strftime('%H:%M:%S')}) Matching {len(parts)} parts with image {j + 1}/{len(self.imageData)}")
+            prepared = self.prepareImage(image)
+            for group in groups.values():
+                imageProcessTime = timer()
+                if vectorized:
+                    descriptors = [part["descriptor"] for part in group]
+                    distances, xs, ys = self.calculateDistanceMaps(descriptors, prepared)
+                    matches = [self.findBestSubset(descriptor, image["descriptor"], partDistances, xs, ys)
+                               for descriptor, partDistances in zip(descriptors, distances)]
+                elif self.coarse is None:
+                    matches = [self.matchImage(part["descriptor"], prepared, part["best"]["distance"]) for part in group]
+                else:
+                    matches = [self.matchImagePyramid(part["descriptor"], part["coarseDescriptor"], prepared) for part in group]
+                time = (timer() - imageProcessTime) / len(group)
+
+                for part, (distance, startX, startY, subsets) in zip(group, matches):
+                    self.updateBest(part["best"], image, part["size"], distance, startX, startY)
+                    part["matchingTime"] += time
+                    self.diagnostics.times.individualImageMatching.append(time)
+                    self.diagnostics.counts.subsets.append(subsets)
+
+        for part in parts:
+            self.diagnostics.counts.scannedImages.append(len(self.imageData))
+            self.diagnostics.times.allImagesMatching.append(part["matchingTime"])
+            self.diagnostics.times.partProcess.append(part["descriptorTime"] + part["matchingTime"])
+            self.appendResult(part["part"], part["best"])
+
+    def usesWorkers(self):
+        # batched matching runs in this process
+        return super().usesWorkers() and not self.batchParts
+
+    def getWorkerData(self):
+        # color images aren't needed for matching
+        workerData = [{key: value for key, value in image.items() if key != "colorImage"} for image in self.imageData]
+        if self.descriptorStore is not None:
+            # pickling mapped arrays would copy them, so stored arrays are sent as ids and every worker
+            # maps the store file on its own (see setWorkerData())
+            for data, ids in zip(workerData, self.storedIds):
+                if "coarse" in data:
+                    data["coarse"] = dict(data["coarse"])
+                for (container, key), arrayId in zip(self.getStoredArrays(data), ids):
+                    container[key] = arrayId
+        return workerData
+
+    def setWorkerData(self, imageData):
+        self.imageData = imageData
+        if self.descriptorStore is not None:
+            for data in self.imageData:
+                self.resolveStoredArrays(data)
+
+    def matchImages(self, partData, indices):
+        """
+        Matches a part with images at given indices, used by worker processes
+
+        :param partData: Tuple (partDescriptor, coarsePartDescriptor)
+        :return: List of tuples (distance, startX, startY, subsets, time) - see matchImage()
+        """
+        partDescriptor, coarsePartDescriptor = partData
+        bound = float("inf")
+        results = []
+        for j in indices:
+            imageProcessTime = timer()
+            if self.coarse is None:
+                distance, startX, startY, subsets = self.matchImage(partDescriptor, self.imageData[j], bound)
+            else:
+                distance, startX, startY, subsets = self.matchImagePyramid(partDescriptor, coarsePartDescriptor, self.imageData[j])
+            bound = min(bound, distance)
+            results.append((distance, startX, startY, subsets, timer() - imageProcessTime))
+        return results
+
+    def getCacheParams(self):
+        """
+        Returns parameters of both fine and coarse descriptors (see getDescriptorParams())
+        """
+        return self.getDescriptorParams(), None if self.coarse is None else self.coarse.getDescriptorParams()
+
+    def getGrayImage(self, image):
+        return image.getGrayImage(self.reduction)
+
+    def getPartSize(self, img):
+        """
+        Returns size (width, height) of a part in pixels of the full resolution image
+        """
+        width, height = self.getSizeFromShape(img.shape)
+        return width * self.reduction, height * self.reduction
+
+    def calculatePartDescriptors(self, img):
+        """
+        Calculates descriptor of a part (and its coarse descriptor for the pyramid search), saves diagnostics
+
+        :return: Tuple (descriptor, coarseDescriptor) - coarseDescriptor is None if pyramid search isn't used
+        """
+        descriptor, time = self.calculateDescriptor(img)
+        coarseDescriptor = None
+        if self.coarse is not None:
+            coarseDescriptor, coarseTime = self.coarse.calculateDescriptor(img)
+            time = time + coarseTime
+
+        self.diagnostics.times.partDescriptor.append(time)
+        self.diagnostics.counts.partDescriptorSize.append(descriptor.size)
+        return descriptor, coarseDescriptor
+
+    @staticmethod
+    def createBest():
+        """
+        Creates the structure for storing the best result of a part
+        """
+        return {
+            "distance": float("inf"),  # default to +infinity
+            "colorImage": None,
+            "path": None,
+            "sX": -1,
+            "sY": -1,
+            "eX": -1,
+            "eY": -1
+        }
+
+    def updateBest(self, best, image, partSize, distance, startX, startY):
+        """
+        Replaces the best result of a part, if the match in given image is better
+        """
+        if distance < best["distance"]:
+            # get "scale" which translates (x,y) pair from the descriptor point of view to pixel (x,y)
+            scaleX, scaleY = self.getResultPointScale()
+            best["distance"] = distance
+            best["colorImage"] = image["colorImage"]
+            best["path"] = image["path"]
+            best["sX"] = startX * scaleX
+            best["sY"] = startY * scaleY
+            best["eX"] = best["sX"] + partSize[0]
+            best["eY"] = best["sY"] + partSize[1]
+
+    def appendResult(self, part, best):
+        # noinspection PyTypeChecker
+        self.results.append(self.MatchingResult(part=self.retainImage(part),
+                                                image=best["colorImage"],
+                                                partPath=part.filePath,
+                                                imagePath=best["path"],
+                                                start=(best["sX"], best["sY"]),
+                                                end=(best["eX"], best["eY"]),
+                                                distance=best["distance"]))
+
+    def prepareImage(self, image):
+        """
+        Precomputes image-side data reused by all parts matched with the image - descriptor in subset layout
+        and its spectrum for FFT matching
+
+        :param image: Preprocessed image (item of imageData)
+        :return: Shallow copy of the image with "layout" (and "spectrum") added
+        """
+        prepared = dict(image)
+        if self.matchingMode != self.MatchingMode.LOOP and "layout" not in prepared:
+            prepared["layout"] = self.toSubsetLayout(image["descriptor"])
+        if self.matchingMode == self.MatchingMode.FFT:
+            prepared["spectrum"] = np.fft.rfft2(prepared["layout"], axes=(0, 1))
+        return prepared
+
+    def getLayout(self, image):
+        """
+        Returns image descriptor in subset layout - prepared or stored one if available (see prepareImage())
+        """
+        return image["layout"] if "layout" in image else self.toSubsetLayout(image["descriptor"])
+
+    def matchImage(self, partDescriptor, image, bound=float("inf")):
+        """
+        Finds the subset of the image descriptor closest to the part descriptor
+
+        :param image: Preprocessed image (item of imageData)
+        :param bound: Best distance found so far (in other images), subsets that aren't better may be skipped
+        :return: Tuple (distance, startX, startY, subsets) - start is in descriptor coordinates, (inf, -1, -1, 0) if the part doesn't fit
+        """
+        if self.matchingMode in (self.MatchingMode.VECTORIZED, self.MatchingMode.FFT):
+            return self.matchImageVectorized(partDescriptor, image)
+        elif self.matchingMode == self.MatchingMode.EARLY_ABANDON:
+            return self.matchImageEarlyAbandon(partDescriptor, image, bound)
+        return self.matchImageLoop(partDescriptor, image["descriptor"])
+
+    def matchImageLoop(self, partDescriptor, imageDescriptor):
+        best = (float("inf"), -1, -1)
+        subsets = 0
+        # extract info about how subsets from the image should be gotten
+        windowSize, imageSize, stepSize = self.getSubsetParams(partDescriptor, imageDescriptor)
+        # iterate through all subsets from the image with the same size as the searched part
+        for startX, startY, endX, endY in self.getSubsets(windowSize, imageSize, stepSize):
+            subsets = subsets + 1
+            subset = self.getSubset(imageDescriptor, startX, startY, endX, endY)
+
+            distance = np.linalg.norm(subset - partDescriptor)  # should calculate the euclidean distance
+
+            if distance < best[0]:
+                best = (distance, startX, startY)
+        return best[0], best[1], best[2], subsets
+
+    def matchImageEarlyAbandon(self, partDescriptor, image, bound=float("inf")):
+        """
+        Evaluates all subsets of the image at once, one row of descriptor points (HOG blocks) at a time,
+        accumulating squared differences - subsets, whose partial sum already exceeds the best distance so far,
+        are abandoned and not evaluated further. Fraction of abandoned subsets is saved in diagnostics
+        """
+        imageDescriptor, integral = image["descriptor"], image["integral"]
+        windowSize, imageSize, stepSize = self.getSubsetParams(partDescriptor, imageDescriptor)
+        xs = np.arange(0, imageSize[0] - windowSize[0], stepSize[0])
+        ys = np.arange(0, imageSize[1] - windowSize[1], stepSize[1])
+        if xs.size == 0 or ys.size == 0:
+            return float("inf"), -1, -1, 0
+
+        layout = self.getLayout(image)
+        part = self.toSubsetLayout(partDescriptor)
+        pH, pW = part.shape[:2]
+        stepX, stepY = stepSize
+        # start points of all subsets in the same order as getSubsets() generates them
+        startXs, startYs = np.tile(xs, ys.size), np.repeat(ys, xs.size)
+        partial = np.zeros(startXs.size)
+        active = np.arange(startXs.size)
+        # squared distance, slightly increased so rounding of partial sums can't abandon a better subset
+        partNorm = np.sum(part ** 2)
+        relax = lambda distance: distance ** 2 * (1 + 1e-5) + 1e-8 * partNorm
+        limit = relax(bound)
+        # gather at most this many values at once
+        batch = max(1, 2 ** 20 // (pW * part.shape[2]))
+
+        for dy in range(pH):
+            if active.size > startXs.size // 8:
+                # most of the subsets are still active, it's cheaper to evaluate the row for all of them,
+                # using the same expansion as calculateDistanceMap()
+                cross = self.correlateRow(layout[ys + dy, :xs[-1] + pW], part[dy])
+                top, left = ys[:, None] + dy, xs[None, :]
+                norms = integral[top + 1, left + pW] - integral[top, left + pW] - integral[top + 1, left] + integral[top, left]
+                partial += (norms + np.sum(part[dy] ** 2) - 2 * cross[:, ::stepX]).ravel()
+            else:
+                for i in range(0, active.size, batch):
+                    indices = active[i:i + batch]
+                    rows = layout[(startYs[indices] + dy)[:, None], startXs[indices][:, None] + np.arange(pW)]
+                    partial[indices] += np.sum((rows - part[dy]) ** 2, axis=(1, 2))
+            if np.isinf(limit):
+                # nothing to compare with yet - the subset with the best start is evaluated completely first
+                candidate = active[np.argmin(partial[active])]
+                limit = relax(self.getSubsetDistance(partDescriptor, imageDescriptor, startXs[candidate], startYs[candidate]))
+            active = active[partial[active] <= limit]
+
+        self.diagnostics.counts.abandonedSubsets.append(1 - active.size / startXs.size)
+
+        # the rest was evaluated completely - partial sums are their squared distances, but (like in findBestSubset())
+        # not exact, so only the ones close to the minimum are evaluated again the same way the loop does it
+        if active.size > 0:
+            distances = partial[active]
+            active = active[distances <= distances.min() * (1 + 1e-5) + 1e-8 * max(distances.max(), partNorm)]
+        best = (float("inf"), -1, -1)
+        for index in active:
+            distance = self.getSubsetDistance(partDescriptor, imageDescriptor, startXs[index], startYs[index])
+            if distance < best[0]:
+                best = (distance, int(startXs[index]), int(startYs[index]))
+        return best[0], best[1], best[2], startXs.size
+
+    def getSubsetDistance(self, partDescriptor, imageDescriptor, startX, startY):
+        """
+        Calculates euclidean distance between the part descriptor and a subset of the image descriptor starting at given point
+        """
+        windowSize, _, _ = self.getSubsetParams(partDescriptor, imageDescriptor)
+        subset = self.getSubset(imageDescriptor, startX, startY, startX + windowSize[0], startY + windowSize[1])
+        return np.linalg.norm(subset - partDescriptor)
+
+    def matchImageVectorized(self, partDescriptor, image):
+        distances, xs, ys = self.calculateDistanceMap(partDescriptor, image)
+        return self.findBestSubset(partDescriptor, image["descriptor"], distances, xs, ys)
+
+    def findBestSubset(self, partDescriptor, imageDescriptor, distances, xs, ys):
+        """
+        Finds the best subset in a distance map (see calculateDistanceMap())
+
+        :return: Same as matchImage()
+        """
+        if distances.size == 0:
+            return float("inf"), -1, -1, 0
+
+        # the expansion in calculateDistanceMap() isn't exact, so the subsets close to the minimum are evaluated again
+        # the same way the loop does it - first one with the smallest distance wins, just like in getSubsets() order
+        minimum = distances.min()
+        candidates = np.flatnonzero(distances <= minimum * (1 + 1e-5) + 1e-8 * distances.max())
+        best = (float("inf"), -1, -1)
+        for index in candidates:
+            startX, startY = int(xs[index % xs.size]), int(ys[index // xs.size])
+            distance = self.getSubsetDistance(partDescriptor, imageDescriptor, startX, startY)
+            if distance < best[0]:
+                best = (distance, startX, startY)
+        return best[0], best[1], best[2], distances.size
+
+    def matchImagePyramid(self, partDescriptor, coarsePartDescriptor, image):
+        """
+        Finds pyramidCandidates best subsets using the coarse descriptors, then searches only their neighbourhood
+        (one coarse step in each direction) using the fine descriptors
+
+        :return: Same as matchImage(), subsets include both coarse and fine ones
+        """
+        coarseDistances, coarseXs, coarseYs = self.coarse.calculateDistanceMap(coarsePartDescriptor, image["coarse"])
+        if coarseDistances.size == 0:
+            # part is too small for the coarse scale, search the entire image instead
+            return self.matchImage(partDescriptor, image)
+
+        imageDescriptor = image["descriptor"]
+        windowSize, imageSize, stepSize = self.getSubsetParams(partDescriptor, imageDescriptor)
+        # same positions as getSubsets() generates
+        validXs = range(0, imageSize[0] - windowSize[0], stepSize[0])
+        validYs = range(0, imageSize[1] - windowSize[1], stepSize[1])
+
+        coarseScaleX, coarseScaleY = self.coarse.getResultPointScale()
+        scaleX, scaleY = self.getResultPointScale()
+        radiusX, radiusY = ceil(coarseScaleX / scaleX), ceil(coarseScaleY / scaleY)
+
+        k = min(self.pyramidCandidates, coarseDistances.size)
+        positions = set()
+        for index in np.argpartition(coarseDistances, k - 1, axis=None)[:k]:
+            # candidate start point converted from coarse to fine descriptor points
+            centerX = int(coarseXs[index % coarseXs.size]) * coarseScaleX // scaleX
+            centerY = int(coarseYs[index // coarseXs.size]) * coarseScaleY // scaleY
+            for y in range(centerY - radiusY, centerY + radiusY + 1):
+                for x in range(centerX - radiusX, centerX + radiusX + 1):
+                    if x in validXs and y in validYs:
+                        positions.add((y, x))
+
+        # evaluate in the same order as getSubsets() would, so ties are resolved the same way
+        best = (float("inf"), -1, -1)
+        for y, x in sorted(positions):
+            distance = self.getSubsetDistance(partDescriptor, imageDescriptor, x, y)
+            if distance < best[0]:
+                best = (distance, x, y)
+        return best[0], best[1], best[2], coarseDistances.size + len(positions)
+
+    def calculateDistanceMap(self, partDescriptor, image):
+        """
+        Calculates squared euclidean distances between the part descriptor and every subset of the image descriptor at once
+
+        :param image: Preprocessed image (item of imageData) - see calculateDistanceMaps()
+        :return: Tuple (distances, xs, ys) - distances is a 2D array indexed [y, x] (same order as getSubsets() generates them),
+                 xs and ys are the start coordinates (in descriptor points) of its columns and rows
+        """
+        distances, xs, ys = self.calculateDistanceMaps([partDescriptor], image)
+        return distances[0], xs, ys
+
+    def calculateDistanceMaps(self, partDescriptors, image):
+        """
+        Calculates squared euclidean distances between each of the part descriptors and every subset of the image descriptor,
+        using ||a - b||^2 = ||a||^2 + ||b||^2 - 2ab - the cross term comes from correlateDirect() or correlateFFT()
+        (depending on matching mode), subset norms from an integral image
+
+        :param partDescriptors: List of part descriptors, all with the same shape
+        :param image: Dictionary with "descriptor" and "integral" (integral image of squared descriptor values summed over
+                      all values of a point, see getIntegralImage()),
+                      optionally "layout" and "spectrum" (see prepareImage())
+        :return: Tuple (distances, xs, ys) - distances is a 3D array indexed [part, y, x], xs and ys are the same as in calculateDistanceMap()
+        """
+        windowSize, imageSize, stepSize = self.getSubsetParams(partDescriptors[0], image["descriptor"])
+        # same positions as getSubsets() generates - the last position is never included there
+        xs = np.arange(0, imageSize[0] - windowSize[0], stepSize[0])
+        ys = np.arange(0, imageSize[1] - windowSize[1], stepSize[1])
+        if xs.size == 0 or ys.size == 0:
+            return np.empty((len(partDescriptors), ys.size, xs.size)), xs, ys
+
+        layout = self.getLayout(image)
+        parts = np.stack([self.toSubsetLayout(descriptor) for descriptor in partDescriptors])
+        pH, pW = parts.shape[1:3]
+        stepX, stepY = stepSize
+
+        # sum of squares of every subset from the integral image
+        integral = image["integral"]
+        top, bottom, left, right = ys[:, None], ys[:, None] + pH, xs[None, :], xs[None, :] + pW
+        subsetNorms = integral[bottom, right] - integral[top, right] - integral[bottom, left] + integral[top, left]
+
+        distances = np.empty((len(partDescriptors), ys.size, xs.size))
+        # limits memory used by intermediate results (products in correlateDirect(), spectra in correlateFFT())
+        chunk = max(1, 2 ** 23 // (layout.shape[0] * layout.shape[1] * max(pW, layout.shape[2])))
+        for i in range(0, len(parts), chunk):
+            if self.matchingMode == self.MatchingMode.FFT:
+                cross = self.correlateFFT(layout, parts[i:i + chunk], image.get("spectrum"))
+            else:
+                cross = self.correlateDirect(layout, parts[i:i + chunk])
+            # only keep the positions generated by getSubsets()
+            cross = cross[:, :ys[-1] + 1:stepY, :xs[-1] + 1:stepX]
+            partNorms = np.sum(parts[i:i + chunk] ** 2, axis=(1, 2, 3))
+            distances[i:i + chunk] = subsetNorms + partNorms[:, None, None] - 2 * cross
+        return np.maximum(distances, 0), xs, ys
+
+    @staticmethod
+    def correlateDirect(image, parts):
+        """
+        Calculates dot product of each part with every same sized subset of the image (all in subset layout),
+        accumulated over the part rows
+
+        :param parts: Parts stacked into one array (part, y, x, values)
+        :return: 3D array (part, y, x) for every possible start point of the parts
+        """
+        count, pH, pW, channels = parts.shape
+        height, width = image.shape[0] - pH + 1, image.shape[1] - pW + 1
+        if channels == 1:
+            # every window of the image as a (height, width, pH, pW) view, rows of windows are copied into a matrix
+            # and multiplied with all parts at once (a few large products instead of pH * pW small ones)
+            values = np.ascontiguousarray(image[:, :, 0])
+            strideY, strideX = values.strides
+            windows = as_strided(values, (height, width, pH, pW), (strideY, strideX, strideY, strideX), writeable=False)
+            kernels = parts.reshape(count, pH * pW).T
+            cross = np.empty((count, height, width))
+            # limits memory used by the copied windows
+            rows = max(1, 2 ** 22 // (width * pH * pW))
+            for y in range(0, height, rows):
+                block = windows[y:y + rows].reshape(-1, pH * pW) @ kernels
+                cross[:, y:y + rows] = block.T.reshape(count, -1, width)
+            return cross
+
+        cross = np.zeros((count, height, width))
+        for dy in range(pH):
+            # dot products of every image point with every point in this row of all parts, (height, image width, part, pW)
+            products = image[dy:dy + height] @ parts[:, dy].reshape(-1, channels).T
+            products = products.reshape(height, image.shape[1], count, pW)
+            for dx in range(pW):
+                cross += np.moveaxis(products[:, dx:dx + width, :, dx], 2, 0)
+        return cross
+
+    @staticmethod
+    def correlateRow(image, row):
+        """
+        Calculates dot product of a single part row (x, values) with every same sized row subset of the image
+        (in subset layout) - cheaper than correlateDirect() with a single row, which is built for many rows and parts
+
+        :return: 2D array (y, x) for every possible start point of the row
+        """
+        pW, channels = row.shape
+        width = image.shape[1] - pW + 1
+        if channels == 1:
+            cross = image[:, :width, 0] * row[0, 0]
+            for dx in range(1, pW):
+                cross += image[:, dx:dx + width, 0] * row[dx, 0]
+            return cross
+        # dot products of every image point with every point of the row in one product, (y, image width, pW)
+        products = image @ row.T
+        cross = products[:, :width, 0].copy()
+        for dx in range(1, pW):
+            cross += products[:, dx:dx + width, dx]
+        return cross
+
+    @staticmethod
+    def correlateFFT(image, parts, imageSpectrum=None):
+        """
+        Same as correlateDirect(), but calculated as a cross-correlation using FFT - O(N log N) instead of O(N * M)
+
+        :param imageSpectrum: Precomputed rfft2 of the image over the first two axes (see prepareImage())
+        """
+        pH, pW = parts.shape[1:3]
+        shape = image.shape[:2]
+        if imageSpectrum is None:
+            imageSpectrum = np.fft.rfft2(image, axes=(0, 1))
+        partSpectra = np.fft.rfft2(parts, s=shape, axes=(1, 2))
+        # channels are summed in the frequency domain, so only one inverse transform per part is needed
+        spectra = np.sum(imageSpectrum * np.conj(partSpectra), axis=3)
+        cross = np.fft.irfft2(spectra, s=shape, axes=(1, 2))
+        # the correlation is circular, the start points where the parts would wrap around are dropped
+        return cross[:, :shape[0] - pH + 1, :shape[1] - pW + 1]
+
+    def toSubsetLayout(self, descriptor):
+        """
+        Converts the descriptor into float64 array (y, x, values), where values are all the numbers belonging to the point (y, x)
+        """
+        xAxis, yAxis = self.getSubsetAxes()
+        descriptor = np.moveaxis(np.asarray(descriptor, dtype=np.float64), (yAxis, xAxis), (0, 1))
+        return np.ascontiguousarray(np.reshape(descriptor, descriptor.shape[:2] + (-1,)))
+
+    @staticmethod
+    def getIntegralImage(values):
+        """
+        Calculates summed-area table over the first two axes of an array (separately for every channel in the rest),
+        padded with zero row and column at the start,
+        so the sum of values[y1:y2, x1:x2] = table[y2, x2] - table[y1, x2] - table[y2, x1] + table[y1, x1]
+        """
+        table = np.zeros((values.shape[0] + 1, values.shape[1] + 1) + values.shape[2:])
+        table[1:, 1:] = np.cumsum(np.cumsum(values, axis=0), axis=1)
+        return table
 
     # implement in child algorithms
 
@@ -120,16 +725,24 @@ class BaseHogFT(BaseAlgorithm):
         """
         pass
 
+    def getSubsetAxes(self) -> object:
+        """
+        Returns which axes of the descriptor correspond to x and y used in getSubset()
+        :return: Tuple (xAxis, yAxis) - (int, int)
+        """
+        pass
+
     def getResultPointScale(self) -> object:
         """
         Returns a "scale" which translates (x,y) pair from the descriptor point of view to pixel (x,y)
+        of the full resolution image (including the reduction)
         :return: Tuple (scaleX, scaleY) - (int, int)
         """
         pass
 
-    def writeSingleResult(self, result, path, includePart=False):
-        path = os.path.abspath(path)
-        resultImage = result.image.copy()
+    def renderResult(self, result, includePart=False) -> np.ndarray:
+        part, image = self.getResultImages(result)
+        resultImage = image.copy()
         resultImage = cv.rectangle(resultImage,
                                    pt1=result.start,
                                    pt2=result.end,
@@ -137,14 +750,13 @@ class BaseHogFT(BaseAlgorithm):
 
         if includePart:
             # create a new image with width = part width + image width, height = image height
-            out = np.zeros((resultImage.shape[0], resultImage.shape[1] + result.part.shape[1], 3), np.uint8)
+            out = np.zeros((resultImage.shape[0], resultImage.shape[1] + part.shape[1], 3), np.uint8)
             # copy part to top left corner (area under it will be black)
-            out[0:result.part.shape[0], 0:result.part.shape[1]] = result.part
+            out[0:part.shape[0], 0:part.shape[1]] = part
             # copy result image next to it
-            out[0:, result.part.shape[1]:] = resultImage
-            cv.imwrite(path, out)
-        else:
-            cv.imwrite(path, resultImage)
+            out[0:, part.shape[1]:] = resultImage
+            return out
+        return resultImage
 
     def printResults(self, filename=None):
         average = {
@@ -171,6 +783,16 @@ class BaseHogFT(BaseAlgorithm):
             f"Average image descriptor size: {average['imageDescriptorSize']}\n",
             f"Average subsets in image: {average['subsets']}"
         ]
+        if len(self.diagnostics.counts.abandonedSubsets) > 0:
+            abandoned = self.avg(self.diagnostics.counts.abandonedSubsets, self.AverageType.COUNT)
+            lines.append(f"\nAverage fraction of abandoned subsets: {abandoned}")
+        if self.stopsEarly():
+            scanned = self.avg(self.diagnostics.counts.scannedImages, self.AverageType.COUNT)
+            lines.append(f"\nAverage images scanned for a part: {scanned}")
+        if len(self.diagnostics.times.resultEncoding) > 0:
+            # only results written before printing (or flushed, with a ResultWriter) are included
+            encoding = self.avg(self.diagnostics.times.resultEncoding)
+            lines.append(f"\nAverage time encoding a result image [ms]: {encoding}")
 
         if not filename is None:
             with open(filename, "w") as file:
@@ -1,24 +1,67 @@
 import cv2 as cv
 import numpy as np
-import os
-from src.algorithms.BaseAlgorithm import BaseAlgorithm
+from numpy.lib.recfunctions import unstructured_to_structured
+from src.algorithms.BaseAlgorithm import BaseAlgorithm, KEYPOINT_DTYPE
 from timeit import default_timer as timer
 
+# number of set bits in every byte value, used for Hamming distances when np.bitwise_count isn't available
+POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
 class BaseKeypointAlgorithm(BaseAlgorithm):
-    bf: cv.BFMatcher      # brute force matcher, its parameter "normType" varies with algorithms (L2 for SIFT/SURF, HAMMING for ORB, BRIEF, FREAK)
+    normType: int         # norm used for matching descriptors (L2 for SIFT/SURF, HAMMING for ORB, BRIEF, FREAK)
+    bf: cv.BFMatcher      # brute force matcher using the norm above
 
-    def __init__(self, parts, images, topMatches=20, drawMatches=True, iteration=None):
-        super().__init__(parts, images, iteration)
+    def __init__(self, parts, images, topMatches=20, drawMatches=True, iteration=None, workers=1, threads=1, descriptorCache=None,
+                 indexedMatching=False, indexNeighbours=10, prefilterImages=None, vocabularySize=500, popcountMatching=False,
+                 stackedMatching=False, acceptDistance=None, acceptRatio=None, partKeypointBudget=None,
+                 imageKeypointBudget=None, keypointGrid=None, lazyImages=False):
+        super().__init__(parts, images, iteration, workers, threads, descriptorCache, acceptDistance, acceptRatio, lazyImages)
         # how many keypoint matches should be taken into account when looking for the best result (also how many matches should be drawn in the result)
         self.topMatches = topMatches
         # if matches should be visualized in the result or not
         self.drawMatches = drawMatches
+        # if parts should be matched with a single FLANN index of all image descriptors instead of every image separately
+        # (see buildIndex() and matchIndexed()), these don't use worker processes
+        self.indexedMatching = indexedMatching
+        # how many nearest image descriptors are found for every part descriptor in the index
+        self.indexNeighbours = indexNeighbours
+        # FLANN matcher over descriptors of all images, index of the image of every indexed descriptor
+        self.index: cv.FlannBasedMatcher = None
+        self.indexImageIds = None
+        # if set, parts are only matched with this many images most similar to them according to a bag of visual words
+        # (see buildVocabulary() and getCandidateImages()), ignored when indexedMatching is used
+        self.prefilterImages = prefilterImages
+        # number of visual words in the vocabulary
+        self.vocabularySize = vocabularySize
+        # visual words (k-means centers of image descriptors), IDF weight of every word
+        self.vocabulary = None
+        self.idf = None
+        # inverted file - images containing each word and its TF-IDF weight in them, sorted by word,
+        # postings of word w are at invertedOffsets[w]:invertedOffsets[w + 1]
+        self.invertedImages = None
+        self.invertedWeights = None
+        self.invertedOffsets = None
+        # if binary descriptors should be matched with NumPy (see matchImagesStacked()) instead of the OpenCV matcher,
+        # this doesn't use worker processes and is ignored for SIFT and SURF
+        self.popcountMatching = popcountMatching
+        # if descriptors of all algorithms should be matched with NumPy, distances of a part to a whole block
+        # of images are calculated at once (see matchImagesStacked()), this doesn't use worker processes either
+        self.stackedMatching = stackedMatching
+        # descriptors of all images in a single matrix, image offsets in it (see stackDescriptors())
+        self.stackedDescriptors = None
+        self.imageOffsets = None
+        # maximum number of keypoints kept for a part and for a database image (None = all detected keypoints),
+        # the ones with the strongest response are kept (see retainKeypoints())
+        self.partKeypointBudget = partKeypointBudget
+        self.imageKeypointBudget = imageKeypointBudget
+        # (columns, rows) of a grid the budget is split between, so that kept keypoints are spread across the image
+        self.keypointGrid = keypointGrid
 
     def processImages(self):
-        for image in self.images:
-            # converts image to gray, calculates keypoints and descriptors for them (somehow)
-            img = cv.cvtColor(image.colorImage, cv.COLOR_BGR2GRAY)
-            keypoints, descriptors, time = self.calculateDescriptor(img)
+        # calculates keypoints and descriptors for all images, this may run in multiple threads (see mapInThreads()),
+        # results are kept in order
+        outputs = self.mapInThreads(lambda algorithm, image: algorithm.preprocessImage(image), self.images)
+        for (keypoints, descriptors, time), image in zip(outputs, self.images):
             # sometimes, there are no keypoints found, check if the output is valid, otherwise skip this image
             ok, error = self.checkValidDetectOutput(keypoints, descriptors)
             if not ok:
@@ -28,20 +71,200 @@ class BaseKeypointAlgorithm(BaseAlgorithm):
             self.diagnostics.counts.imageDescriptorSize.append(descriptors.size)
             # save keypoints, descriptors and image itself to memory
             self.imageData.append({
-                "colorImage": image.colorImage,
+                "colorImage": self.retainImage(image),
                 "path": image.filePath,
                 "keypoints": keypoints,
                 "descriptors": descriptors
             })
 
+        if self.indexedMatching:
+            self.buildIndex()
+        elif self.prefilterImages is not None:
+            self.buildVocabulary()
+        if self.stackedMatching or (self.popcountMatching and self.normType == cv.NORM_HAMMING):
+            self.stackDescriptors()
+
+    def buildIndex(self):
+        """
+        Stacks descriptors of all images into a single FLANN index - KD-trees for float descriptors (SIFT, SURF),
+        LSH for binary descriptors (ORB, BRIEF, FREAK)
+        """
+        if self.normType == cv.NORM_L2:
+            # FLANN_INDEX_KDTREE
+            indexParams = dict(algorithm=1, trees=4)
+        else:
+            # FLANN_INDEX_LSH
+            indexParams = dict(algorithm=6, table_number=6, key_size=12, multi_probe_level=1)
+        self.index = cv.FlannBasedMatcher(indexParams, dict(checks=64))
+        if len(self.imageData) == 0:
+            return
+        counts = [len(image["descriptors"]) for image in self.imageData]
+        self.indexImageIds = np.repeat(np.arange(len(counts)), counts)
+        descriptors = np.vstack([image["descriptors"] for image in self.imageData])
+        if self.normType == cv.NORM_L2:
+            descriptors = descriptors.astype(np.float32, copy=False)
+        self.index.add([descriptors])
+        self.index.train()
+
+    def matchIndexed(self, partDescriptors):
+        """
+        Finds the image most similar to a part with a single query of the FLANN index (see buildIndex())
+
+        Every image gets the same score as in processParts() - sum of its best topMatches match distances - except
+        that the distance of a part descriptor to an image is taken from its nearest neighbours in the index. If none of
+        them is from the image, the distance to the furthest neighbour is used, as the real distance can't be smaller.
+        Part descriptors without any neighbours are left out. Matches of the winning image are then calculated exactly
+        with the brute force matcher.
+
+        :return: Tuple (image, totalDistance, topMatches)
+        """
+        if self.normType == cv.NORM_L2:
+            partDescriptors = partDescriptors.astype(np.float32, copy=False)
+        # LSH may not find any neighbours for some descriptors, they don't tell images apart (with a distance of 0,
+        # they would be the best match in every image)
+        neighbours = [queryNeighbours for queryNeighbours in self.index.knnMatch(partDescriptors, k=self.indexNeighbours)
+                      if len(queryNeighbours) > 0]
+        if len(neighbours) == 0:
+            # nothing to score the images by, they are all matched exactly instead
+            image = min(self.imageData, key=lambda image: self.matchImage(partDescriptors, image["descriptors"])[0])
+        else:
+            distances = np.empty((len(neighbours), len(self.imageData)))
+            for row, queryNeighbours in enumerate(neighbours):
+                trainIds = [match.trainIdx for match in queryNeighbours]
+                distances[row] = queryNeighbours[-1].distance
+                np.minimum.at(distances[row], self.indexImageIds[trainIds], [match.distance for match in queryNeighbours])
+
+            topMatches = min(self.topMatches, len(distances))
+            scores = np.sum(np.partition(distances, topMatches - 1, axis=0)[:topMatches], axis=0)
+            image = self.imageData[int(np.argmin(scores))]
+
+        totalDistance, matches, distances = self.matchImage(partDescriptors, image["descriptors"])
+        return image, totalDistance, self.getTopMatches(matches, distances)
+
+    def buildVocabulary(self):
+        """
+        Trains a visual vocabulary with k-means on a sample of image descriptors (binary descriptors are clustered
+        as vectors of bits, centers are rounded back to bits) and builds an inverted file of TF-IDF weighted words
+        of all images
+        """
+        if len(self.imageData) == 0:
+            return
+        descriptors = np.vstack([image["descriptors"] for image in self.imageData])
+        # sampling and clustering use their own random generator, so building the vocabulary is repeatable
+        # without touching the global generators (e.g. OpenCV's one picks colors in drawMatches())
+        random = np.random.RandomState(0)
+        sample = random.permutation(len(descriptors))[:20 * self.vocabularySize]
+        sample = descriptors[sample] if self.normType == cv.NORM_L2 else np.unpackbits(descriptors[sample], axis=1)
+        words = min(self.vocabularySize, len(sample))
+        centers = self.clusterDescriptors(sample.astype(np.float64), words, random)
+        if self.normType == cv.NORM_L2:
+            self.vocabulary = centers.astype(descriptors.dtype)
+        else:
+            self.vocabulary = np.packbits(centers >= 0.5, axis=1)
+
+        # term frequencies of words in every image
+        frequencies = np.zeros((len(self.imageData), words))
+        for i, image in enumerate(self.imageData):
+            frequencies[i] = self.getWordFrequencies(image["descriptors"])
+        self.idf = np.log(len(self.imageData) / np.maximum(np.count_nonzero(frequencies, axis=0), 1))
+        weights = frequencies * self.idf
+        weights /= np.maximum(np.linalg.norm(weights, axis=1, keepdims=True), np.finfo(np.float64).tiny)
+
+        # nonzero() of the transposed weights returns postings already sorted by word
+        wordIds, imageIds = np.nonzero(weights.T)
+        self.invertedImages = imageIds
+        self.invertedWeights = weights[imageIds, wordIds]
+        self.invertedOffsets = np.searchsorted(wordIds, np.arange(words + 1))
+
+    @staticmethod
+    def clusterDescriptors(sample, clusters, random, iterations=10, epsilon=1e-3):
+        """
+        Clusters the rows of sample with k-means, starting from randomly chosen rows
+
+        :param random: np.random.RandomState used for choosing the initial centers
+        :param epsilon: Clustering stops once no center moves by more than this
+        :return: Array of cluster centers (clusters, sample columns)
+        """
+        centers = sample[random.choice(len(sample), clusters, replace=False)]
+        sampleNorms = np.sum(sample ** 2, axis=1)
+        for _ in range(iterations):
+            # nearest center of every row, ||a - b||^2 = ||a||^2 + ||b||^2 - 2ab
+            distances = sampleNorms[:, None] + np.sum(centers ** 2, axis=1)[None, :] - 2 * sample @ centers.T
+            labels = np.argmin(distances, axis=1)
+            counts = np.bincount(labels, minlength=clusters)
+            sums = np.zeros_like(centers)
+            np.add.at(sums, labels, sample)
+            # empty clusters keep their center
+            updated = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+            shift = np.max(np.linalg.norm(updated - centers, axis=1))
+            centers = updated
+            if shift <= epsilon:
+                break
+        return centers
+
+    def getWordFrequencies(self, descriptors):
+        """
+        Assigns descriptors to their nearest visual words
+
+        :return: Array with the fraction of descriptors assigned to each word
+        """
+        matches = cv.BFMatcher(self.normType).match(descriptors, self.vocabulary)
+        words = np.fromiter((match.trainIdx for match in matches), dtype=np.int64, count=len(matches))
+        return np.bincount(words, minlength=len(self.vocabulary)) / max(len(words), 1)
+
+    def getCandidateImages(self, partDescriptors):
+        """
+        Scores images by the cosine similarity of their TF-IDF word vectors with the part, using the inverted file
+
+        :return: Indices of prefilterImages best images in ascending order (all images if the prefilter isn't used)
+        """
+        if self.vocabulary is None:
+            return list(range(len(self.imageData)))
+        query = self.getWordFrequencies(partDescriptors) * self.idf
+        scores = np.zeros(len(self.imageData))
+        for word in np.flatnonzero(query):
+            postings = slice(self.invertedOffsets[word], self.invertedOffsets[word + 1])
+            # every image is at most once in the postings of a word
+            scores[self.invertedImages[postings]] += query[word] * self.invertedWeights[postings]
+        return sorted(np.argsort(-scores, kind="stable")[:self.prefilterImages].tolist())
+
+    def preprocessImage(self, image):
+        """
+        Calculates keypoints and descriptors of a database image, or loads them from the descriptor cache
+
+        :return: Tuple (keypoints, descriptors, time)
+        """
+        key, cached, time = self.loadFromCache(image, self.getDescriptorParams())
+        # lazily loaded images drop their pixels once they aren't needed anymore
+        if cached is not None:
+            image.release(self.lazyImages)
+            keypoints = cached["keypoints"]
+            if keypoints.dtype != KEYPOINT_DTYPE:
+                # cached before keypoints were structured arrays - rows of (x, y, size, angle, response, octave, class_id)
+                keypoints = unstructured_to_structured(keypoints, KEYPOINT_DTYPE)
+            return keypoints, cached["descriptors"], time
+
+        # converts image to gray, calculates keypoints and descriptors for them (somehow)
+        img = self.getGrayImage(image)
+        keypoints, descriptors, time = self.calculateDescriptor(img, self.imageKeypointBudget)
+        image.release(self.lazyImages)
+        keypoints = self.keypointsToArray(keypoints)
+        ok, _ = self.checkValidDetectOutput(keypoints, descriptors)
+        # invalid outputs aren't cached, they are skipped in processImages() anyway
+        if key is not None and ok:
+            self.descriptorCache.save(key, {"keypoints": keypoints, "descriptors": descriptors})
+        return keypoints, descriptors, time
+
     def processParts(self):
         for part in self.parts:
             partProcessTime = timer()
             # convert part to gray, calculate keypoints and descriptors for it
-            img = cv.cvtColor(part.colorImage, cv.COLOR_BGR2GRAY)
+            img = self.getGrayImage(part)
             partSize = self.getSizeFromShape(img.shape)
 
-            partKeypoints, partDescriptors, time = self.calculateDescriptor(img)
+            partKeypoints, partDescriptors, time = self.calculateDescriptor(img, self.partKeypointBudget)
+            part.release(self.lazyImages)
+            partKeypoints = self.keypointsToArray(partKeypoints)
             # check output for validity, skip part otherwise
             ok, error = self.checkValidDetectOutput(partKeypoints, partDescriptors)
             if not ok:
@@ -54,43 +277,96 @@ class BaseKeypointAlgorithm(BaseAlgorithm):
             # structure for storing the best result
             # topMatches contains the keypoint matches
             # which themselves contain the source and target image + coordinates
+            # (in the serial loop, all matches with the image and their distances are kept, topMatches are selected at the end)
             best = {
                 "image": None,
                 "distance": float("inf"),
                 "topMatches": [],
+                "matches": [],
+                "distances": None,
+                "index": None
             }
 
             allImageProcessTime = timer()
-            for image in self.imageData:
-                imageProcessTime = timer()
-                # brute-force match all part descriptors with image descriptors
-                matches = self.bf.match(partDescriptors, image["descriptors"])
-
-                # sort matches by distance, take certain amount of best ones and sum the distances
-                matches = sorted(matches, key=lambda x: x.distance)
-                matches = matches[:self.topMatches]
-                totalDistance = np.sum(np.asarray(list(map(lambda match: match.distance, matches))))
+            if self.index is not None:
+                best["image"], best["distance"], best["topMatches"] = self.matchIndexed(partDescriptors)
+                # images aren't matched individually, the time is split evenly between them
+                time = (timer() - allImageProcessTime) / len(self.imageData)
+                self.diagnostics.times.individualImageMatching.extend([time] * len(self.imageData))
+                self.diagnostics.counts.scannedImages.append(len(self.imageData))
+            elif self.stackedDescriptors is not None:
+                # when stopping early, blocks of images after the confident match aren't evaluated at all
+                candidates = self.getScanOrder(self.getCandidateImages(partDescriptors))
+                scanned = []
+                for j, (totalDistance, queryIdx, trainIdx, distances) in zip(candidates, self.matchImagesStacked(partDescriptors, candidates)):
+                    scanned.append(totalDistance)
+                    if totalDistance < best["distance"]:
+                        best["image"] = self.imageData[j]
+                        best["index"] = j
+                        best["distance"] = totalDistance
+                        best["matches"] = (queryIdx, trainIdx, distances)
+                        best["distances"] = distances
+                    if self.stopsEarly() and self.isConfident(best["distance"], scanned):
+                        break
+                # distances to images are calculated together, the time is split evenly between them
+                time = (timer() - allImageProcessTime) / len(scanned)
+                self.diagnostics.times.individualImageMatching.extend([time] * len(scanned))
+                self.diagnostics.counts.scannedImages.append(len(scanned))
+                # DMatch objects are only created for the best image
+                matches = [cv.DMatch(int(queryIdx), int(trainIdx), 0, float(distance)) for queryIdx, trainIdx, distance in zip(*best["matches"])]
+                best["topMatches"] = self.getTopMatches(matches, best["distances"])
+            elif self.pool is not None:
+                # matching is scattered across worker processes, measured times are the ones from the workers
+                # (matches are only sent for images that were the best in their worker's chunk at the time)
+                candidates = self.getCandidateImages(partDescriptors)
+                for j, (totalDistance, matches, time) in zip(candidates, self.matchImagesParallel(partDescriptors, candidates)):
+                    image = self.imageData[j]
+                    if totalDistance < best["distance"]:
+                        best["image"] = image
+                        best["distance"] = totalDistance
+                        best["topMatches"] = matches
+                    self.diagnostics.times.individualImageMatching.append(time)
+                self.diagnostics.counts.scannedImages.append(len(candidates))
+                # workers return matches as tuples, since DMatch can't be pickled
+                best["topMatches"] = [cv.DMatch(queryIdx, trainIdx, 0, distance) for queryIdx, trainIdx, distance in best["topMatches"]]
+            else:
+                scanned = []
+                for j in self.getScanOrder(self.getCandidateImages(partDescriptors)):
+                    image = self.imageData[j]
+                    imageProcessTime = timer()
+                    # brute-force match all part descriptors with image descriptors, sum the distances of the best ones
+                    totalDistance, matches, distances = self.matchImage(partDescriptors, image["descriptors"])
+                    scanned.append(totalDistance)
 
-                if totalDistance < best["distance"]:
-                    best["image"] = image
-                    best["distance"] = totalDistance
-                    best["topMatches"] = matches
+                    if totalDistance < best["distance"]:
+                        best["image"] = image
+                        best["index"] = j
+                        best["distance"] = totalDistance
+                        best["matches"] = matches
+                        best["distances"] = distances
 
-                self.diagnostics.times.individualImageMatching.append(timer() - imageProcessTime)
+                    self.diagnostics.times.individualImageMatching.append(timer() - imageProcessTime)
+                    if self.stopsEarly() and self.isConfident(best["distance"], scanned):
+                        break
+                self.diagnostics.counts.scannedImages.append(len(scanned))
+                # DMatch objects are only sorted for the best image
+                best["topMatches"] = self.getTopMatches(best["matches"], best["distances"])
 
             end = timer()
             self.diagnostics.times.allImagesMatching.append(end - allImageProcessTime)
             self.diagnostics.times.partProcess.append(end - partProcessTime)
+            if best["index"] is not None:
+                self.addRecentImage(best["index"])
 
             # process result - extract start and end points of the rectangle, where part was found
             bestMatch = best["topMatches"][0]
             bestKeypointPart = partKeypoints[bestMatch.queryIdx]
             bestKeypointImage = best["image"]["keypoints"][bestMatch.trainIdx]
-            startX = np.round(bestKeypointImage.pt[0] - bestKeypointPart.pt[0]).astype(int)
-            startY = np.round(bestKeypointImage.pt[1] - bestKeypointPart.pt[1]).astype(int)
+            startX = np.round(float(bestKeypointImage["x"]) - float(bestKeypointPart["x"])).astype(int)
+            startY = np.round(float(bestKeypointImage["y"]) - float(bestKeypointPart["y"])).astype(int)
             endX, endY = startX + partSize[0], startY + partSize[1]
 
-            self.results.append(self.MatchingResult(part=part.colorImage,
+            self.results.append(self.MatchingResult(part=self.retainImage(part),
                                                     image=best["image"]["colorImage"],
                                                     partPath=part.filePath,
                                                     imagePath=best["image"]["path"],
@@ -98,20 +374,191 @@ class BaseKeypointAlgorithm(BaseAlgorithm):
                                                     end=(endX, endY),
                                                     partKeypoints=partKeypoints,
                                                     imageKeypoints=best["image"]["keypoints"],
-                                                    topMatches=best["topMatches"]))
+                                                    topMatches=best["topMatches"],
+                                                    distance=best["distance"]))
+
+    def __getstate__(self):
+        # OpenCV detectors, extractors and matchers can't be pickled, workers only need the matcher
+        state = super().__getstate__()
+        return {name: value for name, value in state.items() if not isinstance(value, cv.Algorithm)}
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.bf = cv.BFMatcher(self.normType, crossCheck=True)
+        self.index = None
+
+    def usesWorkers(self):
+        # indexed and stacked matching run in this process (both are set up in processImages())
+        return super().usesWorkers() and self.index is None and self.stackedDescriptors is None
+
+    def getWorkerData(self):
+        return [{"descriptors": image["descriptors"]} for image in self.imageData]
+
+    def matchImages(self, partData, indices):
+        """
+        Matches part descriptors with images at given indices, used by worker processes
+
+        :param partData: Part descriptors
+        :return: List of tuples (totalDistance, topMatches, time), matches are tuples (queryIdx, trainIdx, distance)
+                 and are only included for images better than all previous ones in indices (None otherwise)
+        """
+        results = []
+        bestDistance = float("inf")
+        for j in indices:
+            imageProcessTime = timer()
+            totalDistance, matches, distances = self.matchImage(partData, self.imageData[j]["descriptors"])
+            topMatches = None
+            if totalDistance < bestDistance:
+                bestDistance = totalDistance
+                topMatches = [(match.queryIdx, match.trainIdx, match.distance) for match in self.getTopMatches(matches, distances)]
+            results.append((totalDistance, topMatches, timer() - imageProcessTime))
+        return results
+
+    def matchImage(self, partDescriptors, imageDescriptors):
+        """
+        Brute force matches part descriptors with image descriptors
+
+        :return: Tuple (totalDistance, matches, distances) - sum of the topMatches smallest distances, all matches
+                 (unsorted) and their distances as an array
+        """
+        matches = self.bf.match(partDescriptors, imageDescriptors)
+        distances = np.fromiter((match.distance for match in matches), dtype=np.float64, count=len(matches))
+        return self.sumTopDistances(distances), matches, distances
+
+    def sumTopDistances(self, distances):
+        """
+        Sums topMatches smallest distances in ascending order, same as when summing sorted matches
+        """
+        topMatches = min(self.topMatches, len(distances))
+        if topMatches < len(distances):
+            distances = np.partition(distances, topMatches - 1)[:topMatches]
+        return np.sum(np.sort(distances))
+
+    def stackDescriptors(self):
+        """
+        Concatenates descriptors of all images into a single matrix, descriptors of image i are the rows
+        imageOffsets[i]:imageOffsets[i + 1]
+        """
+        if len(self.imageData) == 0:
+            return
+        self.stackedDescriptors = np.vstack([image["descriptors"] for image in self.imageData])
+        self.imageOffsets = np.cumsum([0] + [len(image["descriptors"]) for image in self.imageData])
+
+    def matchImagesStacked(self, partDescriptors, indices):
+        """
+        Matches part descriptors with images at given indices the same way as BFMatcher with crossCheck, but distances
+        to descriptors of many images are calculated at once with NumPy, using the stacked descriptors (see stackDescriptors())
+
+        :return: Generator of tuples (totalDistance, queryIdx, trainIdx, distances) for every image, matches are given as arrays
+        """
+        # images are processed in blocks, so that distances of the part descriptors to a block take around 20 MB
+        # (including temporary arrays, see getHammingDistances() and crossCheck())
+        blockRows = max(1, 2**21 // len(partDescriptors))
+        imageCounts = np.diff(self.imageOffsets)
+        start = 0
+        while start < len(indices):
+            end = start + 1
+            rows = imageCounts[indices[start]]
+            while end < len(indices) and rows + imageCounts[indices[end]] <= blockRows:
+                rows += imageCounts[indices[end]]
+                end += 1
+            block = indices[start:end]
+            counts = imageCounts[block]
+            if block[-1] - block[0] == len(block) - 1:
+                # consecutive images are a view of the stacked descriptors
+                descriptors = self.stackedDescriptors[self.imageOffsets[block[0]]:self.imageOffsets[block[-1] + 1]]
+            else:
+                descriptors = np.vstack([self.stackedDescriptors[self.imageOffsets[j]:self.imageOffsets[j + 1]] for j in block])
+
+            if self.normType == cv.NORM_HAMMING:
+                distances = self.getHammingDistances(partDescriptors, descriptors)
+            else:
+                distances = self.getL2Distances(partDescriptors, descriptors)
+            yield from self.crossCheck(distances, np.concatenate(([0], np.cumsum(counts))))
+            start = end
+
+    def crossCheck(self, distances, offsets):
+        """
+        Keeps only pairs of descriptors that are each other's nearest neighbours within an image (first one on ties),
+        for all images in a block at once
+
+        :param distances: Distances of part descriptors to descriptors of the images in the block
+        :param offsets: Descriptors of image i are the columns offsets[i]:offsets[i + 1]
+        :return: List of tuples (totalDistance, queryIdx, trainIdx, distances) for every image in the block
+        """
+        columns = np.arange(distances.shape[1])
+        # nearest part descriptor of every image descriptor
+        bestQuery = np.argmin(distances, axis=0)
+        # nearest descriptor of every image for every part descriptor
+        minimum = np.minimum.reduceat(distances, offsets[:-1], axis=1)
+        isMinimum = distances == np.repeat(minimum, np.diff(offsets), axis=1)
+        bestTrain = np.minimum.reduceat(np.where(isMinimum, columns, len(columns)), offsets[:-1], axis=1)
+        mutual = bestQuery[bestTrain] == np.arange(len(distances))[:, None]
+
+        results = []
+        for i in range(len(offsets) - 1):
+            queryIdx = np.flatnonzero(mutual[:, i])
+            trainIdx = bestTrain[queryIdx, i]
+            matchDistances = distances[queryIdx, trainIdx].astype(np.float64)
+            results.append((self.sumTopDistances(matchDistances), queryIdx, trainIdx - offsets[i], matchDistances))
+        return results
+
+    def getTopMatches(self, matches, distances):
+        """
+        Selects topMatches matches with the smallest distances, sorted by distance (ties keep their original order)
+        """
+        if distances is None:
+            return []
+        return [matches[i] for i in np.argsort(distances, kind="stable")[:self.topMatches]]
+
+    def getDescriptorParams(self):
+        # detectors and extractors are created with default parameters
+        if self.imageKeypointBudget is None:
+            return type(self).__name__
+        return type(self).__name__, self.imageKeypointBudget, self.keypointGrid
+
+    def retainKeypoints(self, keypoints, shape, budget):
+        """
+        Keeps at most budget keypoints with the strongest response. With keypointGrid, the budget is split evenly
+        between cells of the grid and the strongest keypoints of each cell are kept - budget left over by cells
+        with fewer keypoints goes to the strongest remaining keypoints anywhere in the image
+
+        :param shape: Shape of the image the keypoints were detected in
+        :return: List of kept keypoints, in the order they were detected
+        """
+        if budget is None or len(keypoints) <= budget:
+            return list(keypoints)
+        # strongest first, ties keep the detection order
+        order = np.argsort(-np.array([keypoint.response for keypoint in keypoints]), kind="stable")
+        if self.keypointGrid is None:
+            kept = order[:budget]
+        else:
+            columns, rows = self.keypointGrid
+            points = np.array([keypoint.pt for keypoint in keypoints])
+            cellX = np.clip((points[:, 0] * columns / shape[1]).astype(int), 0, columns - 1)
+            cellY = np.clip((points[:, 1] * rows / shape[0]).astype(int), 0, rows - 1)
+            cells = (cellY * columns + cellX)[order]
+            # rank of every keypoint by response within its cell
+            byCell = np.argsort(cells, kind="stable")
+            rank = np.empty(len(cells), dtype=np.int64)
+            rank[byCell] = np.arange(len(cells)) - np.searchsorted(cells[byCell], cells[byCell])
+            inCell = rank < budget // (columns * rows)
+            kept = np.concatenate((order[inCell], order[~inCell][:budget - np.count_nonzero(inCell)]))
+        return [keypoints[i] for i in np.sort(kept)]
 
     # implement in child algorithms
 
-    def calculateDescriptor(self, img) -> object:
+    def calculateDescriptor(self, img, budget=None) -> object:
         """
         Calculates keypoints and descriptors for given image
+        :param budget: Maximum number of keypoints to keep (see retainKeypoints()), all of them if None
         :return: Tuple (keypoints, descriptors, time)
         """
         pass
 
-    def writeSingleResult(self, result, path, includePart=False):
-        path = os.path.abspath(path)
-        resultImage = result.image.copy()
+    def renderResult(self, result, includePart=False) -> np.ndarray:
+        part, image = self.getResultImages(result)
+        resultImage = image.copy()
         resultImage = cv.rectangle(img=resultImage,
                                    pt1=result.start,
                                    pt2=result.end,
@@ -119,22 +566,20 @@ class BaseKeypointAlgorithm(BaseAlgorithm):
         if self.drawMatches:
             # OpenCV's drawMatches() does the same as the elif branch under this one
             # combines part and target image into one and draws matches between corresponding keypoints
-            resultImage = cv.drawMatches(img1=result.part.copy(),
-                                         keypoints1=result.partKeypoints,
-                                         img2=resultImage,
-                                         keypoints2=result.imageKeypoints,
-                                         matches1to2=result.topMatches,
-                                         outImg=resultImage,
-                                         flags=cv.DRAW_MATCHES_FLAGS_NOT_DRAW_SINGLE_POINTS)
-            cv.imwrite(path, resultImage)
+            return cv.drawMatches(img1=part.copy(),
+                                  keypoints1=self.keypointsFromArray(result.partKeypoints),
+                                  img2=resultImage,
+                                  keypoints2=self.keypointsFromArray(result.imageKeypoints),
+                                  matches1to2=result.topMatches,
+                                  outImg=resultImage,
+                                  flags=cv.DRAW_MATCHES_FLAGS_NOT_DRAW_SINGLE_POINTS)
         elif includePart:
-            # create a new image which combines part and target image, save to file
-            out = np.zeros((resultImage.shape[0], resultImage.shape[1] + result.part.shape[1], 3), np.uint8)
-            out[0:result.part.shape[0], 0:result.part.shape[1]] = result.part
-            out[0:, result.part.shape[1]:] = resultImage
-            cv.imwrite(path, out)
-        else:
-            cv.imwrite(path, resultImage)
+            # create a new image which combines part and target image
+            out = np.zeros((resultImage.shape[0], resultImage.shape[1] + part.shape[1], 3), np.uint8)
+            out[0:part.shape[0], 0:part.shape[1]] = part
+            out[0:, part.shape[1]:] = resultImage
+            return out
+        return resultImage
 
     def printResults(self, filename=None):
         average = {
@@ -159,6 +604,13 @@ class BaseKeypointAlgorithm(BaseAlgorithm):
             f"Average part descriptor size: {average['partDescriptorSize']}\n",
             f"Average image descriptor size: {average['imageDescriptorSize']}"
         ]
+        if self.stopsEarly():
+            scanned = self.avg(self.diagnostics.counts.scannedImages, self.AverageType.COUNT)
+            lines.append(f"\nAverage images scanned for a part: {scanned}")
+        if len(self.diagnostics.times.resultEncoding) > 0:
+            # only results written before printing (or flushed, with a ResultWriter) are included
+            encoding = self.avg(self.diagnostics.times.resultEncoding)
+            lines.append(f"\nAverage time encoding a result image [ms]: {encoding}")
 
         if not filename is None:
             with open(filename, "w") as file:
@@ -169,6 +621,57 @@ class BaseKeypointAlgorithm(BaseAlgorithm):
                 print(line)
 
 
+    @staticmethod
+    def keypointsToArray(keypoints):
+        """
+        Converts keypoints into a structured Numpy array (see KEYPOINT_DTYPE)
+        """
+        return np.array([(kp.pt[0], kp.pt[1], kp.size, kp.angle, kp.response, kp.octave, kp.class_id) for kp in keypoints],
+                        dtype=KEYPOINT_DTYPE)
+
+    @staticmethod
+    def keypointsFromArray(array):
+        """
+        Converts array from keypointsToArray() back to a list of cv.KeyPoint
+        """
+        return [cv.KeyPoint(float(x), float(y), float(size), float(angle), float(response), int(octave), int(classId))
+                for x, y, size, angle, response, octave, classId in array.tolist()]
+
+    @staticmethod
+    def getHammingDistances(descriptors1, descriptors2):
+        """
+        Calculates Hamming distances between all pairs of packed binary descriptors
+
+        :return: Array of shape (len(descriptors1), len(descriptors2))
+        """
+        if hasattr(np, "bitwise_count") and descriptors1.shape[1] % 8 == 0:
+            # fewer, larger words to count bits in
+            words1 = np.ascontiguousarray(descriptors1).view(np.uint64)
+            words2 = np.ascontiguousarray(descriptors2).view(np.uint64)
+        else:
+            words1, words2 = descriptors1, descriptors2
+        # distances are accumulated word by word, which avoids a 3D array of all XORed words
+        words2 = np.ascontiguousarray(words2.T)
+        distances = np.zeros((len(words1), words2.shape[1]), dtype=np.uint16)
+        xor = np.empty(distances.shape, dtype=words1.dtype)
+        for word in range(words1.shape[1]):
+            np.bitwise_xor(words1[:, word, None], words2[word], out=xor)
+            distances += np.bitwise_count(xor) if hasattr(np, "bitwise_count") else POPCOUNT[xor]
+        return distances
+
+    @staticmethod
+    def getL2Distances(descriptors1, descriptors2):
+        """
+        Calculates Euclidean distances between all pairs of descriptors (in double precision, rounded to float like
+        the distances from OpenCV matchers)
+
+        :return: Array of shape (len(descriptors1), len(descriptors2))
+        """
+        descriptors1 = descriptors1.astype(np.float64)
+        descriptors2 = descriptors2.astype(np.float64)
+        squared = np.sum(descriptors1 ** 2, axis=1)[:, None] + np.sum(descriptors2 ** 2, axis=1)[None, :] - 2 * descriptors1 @ descriptors2.T
+        return np.sqrt(np.maximum(squared, 0)).astype(np.float32)
+
     @staticmethod
     def checkValidDetectOutput(keypoints, descriptors):
         if len(keypoints) == 0:
@@ -0,0 +1,57 @@
+import cv2 as cv
+import hashlib
+import os
+import threading
+import numpy as np
+
+class DescriptorCache:
+    def __init__(self, directory):
+        """
+        Persistent cache of descriptors calculated for database images, stored as .npz files
+
+        :param directory: Directory where the cached descriptors are stored (created if it doesn't exist)
+        """
+        self.directory = os.path.abspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def getKey(image, params):
+        """
+        Creates a cache key from image content and parameters of the algorithm that calculates its descriptors
+
+        :param image: Image (Numpy array) the descriptors are calculated from
+        :param params: Anything with stable repr() describing the algorithm and its parameters
+        :return: Hex digest (string)
+        """
+        digest = hashlib.sha1()
+        # descriptors may differ between OpenCV versions
+        digest.update(repr((cv.__version__, params, image.shape, str(image.dtype))).encode())
+        digest.update(np.ascontiguousarray(image).data)
+        return digest.hexdigest()
+
+    def load(self, key):
+        """
+        Loads cached arrays
+
+        :return: Dictionary of Numpy arrays saved by save(), None if there's nothing cached for the key
+        """
+        path = self.getPath(key)
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+
+    def save(self, key, arrays):
+        """
+        Saves arrays into the cache - written into a temporary file first, so concurrent readers never see a partial file
+
+        :param arrays: Dictionary of Numpy arrays
+        """
+        path = self.getPath(key)
+        temporaryPath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporaryPath, "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(temporaryPath, path)
+
+    def getPath(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
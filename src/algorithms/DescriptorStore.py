@@ -0,0 +1,76 @@
+import os
+import numpy as np
+
+class DescriptorStore:
+    # stored arrays start at multiples of this many bytes
+    ALIGNMENT = 64
+
+    def __init__(self, path):
+        """
+        Descriptors of database images stored in a single file, read back as views into one memory-mapped array,
+        so they don't have to fit into memory
+
+        :param path: Path of the store file (overwritten by reset())
+        """
+        self.path = os.path.abspath(path)
+        # (offset, shape, dtype) of every stored array
+        self.index = []
+        self.file = None
+        self.data = None
+
+    def __getstate__(self):
+        # worker processes map the finished file on their own (see get()), instead of receiving a copy of it
+        state = dict(self.__dict__)
+        state["file"] = None
+        state["data"] = None
+        return state
+
+    def reset(self):
+        """
+        Removes all stored arrays and starts writing a new store file.
+        The old file is unlinked rather than truncated, so arrays mapped from it stay valid
+        """
+        if self.file is not None:
+            self.file.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.index = []
+        self.file = open(self.path, "wb")
+        self.data = None
+
+    def add(self, array) -> int:
+        """
+        Appends an array to the store file
+
+        :return: Id of the array, used in get() once the store is opened
+        """
+        array = np.ascontiguousarray(array)
+        offset = self.file.tell()
+        padding = -offset % self.ALIGNMENT
+        self.file.write(b"\0" * padding)
+        self.file.write(array.data)
+        self.index.append((offset + padding, array.shape, array.dtype.str))
+        return len(self.index) - 1
+
+    def open(self):
+        """
+        Finishes writing and maps the store file into memory
+        """
+        self.file.close()
+        self.file = None
+        if os.path.getsize(self.path) == 0:
+            # empty files can't be mapped
+            self.data = np.empty(0, dtype=np.uint8)
+        else:
+            self.data = np.memmap(self.path, dtype=np.uint8, mode="r")
+
+    def get(self, arrayId) -> np.ndarray:
+        """
+        Returns a read-only view of a stored array - no data is read until it's accessed
+        """
+        if self.data is None:
+            self.data = np.memmap(self.path, dtype=np.uint8, mode="r")
+        offset, shape, dtype = self.index[arrayId]
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * dtype.itemsize
+        return self.data[offset:offset + size].view(dtype).reshape(shape)
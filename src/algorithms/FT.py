@@ -4,11 +4,17 @@ from src.algorithms.BaseHogFT import BaseHogFT
 from timeit import default_timer as timer
 
 class FT(BaseHogFT):
-    def __init__(self, parts, images, kernelRadius=8, iteration=None):
-        super().__init__(parts, images, iteration)
+    def __init__(self, parts, images, kernelRadius=8, iteration=None, matchingMode=BaseHogFT.MatchingMode.LOOP,
+                 coarseKernelRadius=None, pyramidCandidates=5, batchParts=False, workers=1, threads=1, descriptorCache=None,
+                 descriptorStore=None, acceptDistance=None, acceptRatio=None, lazyImages=False, reduction=1):
+        super().__init__(parts, images, iteration, matchingMode, pyramidCandidates, batchParts, workers, threads, descriptorCache,
+                         descriptorStore, acceptDistance, acceptRatio, lazyImages, reduction)
         # parameters for FTransform
         self.kernelRadius = kernelRadius
         self.kernel = ft.createKernel(ft.LINEAR, self.kernelRadius, chn=1)
+        # coarse-to-fine search is used if coarse radius is set
+        if coarseKernelRadius is not None:
+            self.coarse = FT([], [], coarseKernelRadius, iteration, matchingMode, reduction=reduction)
 
     def calculateDescriptor(self, img) -> object:
         t = timer()
@@ -17,6 +23,9 @@ class FT(BaseHogFT):
 
         return components, t
 
+    def getDescriptorParams(self):
+        return "FT", self.kernelRadius
+
     def getSubsetParams(self, partDescriptor, imageDescriptor) -> object:
         return self.getSizeFromShape(partDescriptor.shape)[:2], \
                self.getSizeFromShape(imageDescriptor.shape)[:2], \
@@ -25,8 +34,11 @@ class FT(BaseHogFT):
     def getSubset(self, descriptor, startX, startY, endX, endY) -> np.ndarray:
         return descriptor[startY:endY, startX:endX]
 
+    def getSubsetAxes(self) -> object:
+        return 1, 0
+
     def getResultPointScale(self) -> object:
-        return self.kernelRadius, self.kernelRadius
+        return self.kernelRadius * self.reduction, self.kernelRadius * self.reduction
 
     # @staticmethod
     # def getOptimalRadius(height, width):
@@ -4,8 +4,11 @@ from src.algorithms.BaseHogFT import BaseHogFT
 from timeit import default_timer as timer
 
 class HOG(BaseHogFT):
-    def __init__(self, parts, images, cellSide=4, iteration=None):
-        super().__init__(parts, images, iteration)
+    def __init__(self, parts, images, cellSide=4, iteration=None, matchingMode=BaseHogFT.MatchingMode.LOOP,
+                 coarseCellSide=None, pyramidCandidates=5, batchParts=False, workers=1, threads=1, descriptorCache=None,
+                 descriptorStore=None, acceptDistance=None, acceptRatio=None, lazyImages=False, reduction=1):
+        super().__init__(parts, images, iteration, matchingMode, pyramidCandidates, batchParts, workers, threads, descriptorCache,
+                         descriptorStore, acceptDistance, acceptRatio, lazyImages, reduction)
         # parameters for HOGDescriptor
         self.cellSide = cellSide
         self.cellSize = (self.cellSide, self.cellSide)  # w x h
@@ -22,6 +25,10 @@ class HOG(BaseHogFT):
         self.nLevels = 64
         self.signedGradients = True
 
+        # coarse-to-fine search is used if coarse cell side is set
+        if coarseCellSide is not None:
+            self.coarse = HOG([], [], coarseCellSide, iteration, matchingMode, reduction=reduction)
+
     def calculateDescriptor(self, img) -> object:
         croppedSize = self.getCroppedSize(self.cellSize, self.getSizeFromShape(img.shape))
         copy = cv.resize(img, croppedSize)
@@ -49,14 +56,21 @@ class HOG(BaseHogFT):
 
         return reshapedDescriptor, t
 
+    def getDescriptorParams(self):
+        return "HOG", self.cellSide, self.nBins, self.derivAperture, self.winSigma, self.histogramNormType, \
+               self.L2HysThreshold, self.gammaCorrection, self.nLevels, self.signedGradients
+
     def getSubsetParams(self, partDescriptor, imageDescriptor) -> object:
         return partDescriptor.shape[:2], imageDescriptor.shape[:2], (1, 1)
 
     def getSubset(self, descriptor, startX, startY, endX, endY) -> np.ndarray:
         return descriptor[startX:endX, startY:endY, :, :]
 
+    def getSubsetAxes(self) -> object:
+        return 0, 1
+
     def getResultPointScale(self) -> object:
-        return self.blockStride[0], self.blockStride[1]
+        return self.blockStride[0] * self.reduction, self.blockStride[1] * self.reduction
 
     @staticmethod
     def getReshapedSize(descriptorSize, winSize, blockSize, blockStride):
@@ -3,14 +3,27 @@ from src.algorithms.BaseKeypointAlgorithm import BaseKeypointAlgorithm
 from timeit import default_timer as timer
 
 class ORB(BaseKeypointAlgorithm):
-    def __init__(self, parts, images, topMatches=20, drawMatches=True, iteration=None):
-        super().__init__(parts, images, topMatches, drawMatches, iteration)
-        self.bf = cv.BFMatcher(cv.NORM_HAMMING, crossCheck=True)
+    def __init__(self, parts, images, topMatches=20, drawMatches=True, iteration=None, workers=1, threads=1, descriptorCache=None,
+                 indexedMatching=False, indexNeighbours=10, prefilterImages=None, vocabularySize=500, popcountMatching=False,
+                 stackedMatching=False, acceptDistance=None, acceptRatio=None, partKeypointBudget=None,
+                 imageKeypointBudget=None, keypointGrid=None, lazyImages=False):
+        super().__init__(parts, images, topMatches, drawMatches, iteration, workers, threads, descriptorCache,
+                         indexedMatching, indexNeighbours, prefilterImages, vocabularySize, popcountMatching, stackedMatching,
+                         acceptDistance, acceptRatio, partKeypointBudget, imageKeypointBudget, keypointGrid, lazyImages)
+        self.normType = cv.NORM_HAMMING
+        self.bf = cv.BFMatcher(self.normType, crossCheck=True)
+        self.createDetectors()
+
+    def createDetectors(self):
         self.orb = cv.ORB_create()
 
-    def calculateDescriptor(self, img):
+    def calculateDescriptor(self, img, budget=None):
         t = timer()
-        keypoints, descriptors = self.orb.detectAndCompute(img, None)
+        if budget is None:
+            keypoints, descriptors = self.orb.detectAndCompute(img, None)
+        else:
+            keypoints = self.retainKeypoints(self.orb.detect(img, None), img.shape, budget)
+            keypoints, descriptors = self.orb.compute(img, keypoints)
         t = timer() - t
 
         return keypoints, descriptors, t
@@ -0,0 +1,114 @@
+import atexit
+import os
+import queue
+import threading
+import cv2 as cv
+from timeit import default_timer as timer
+
+class ResultWriter:
+    def __init__(self, threads=2, queueSize=16, jpegQuality=None, pngCompression=None):
+        """
+        Encodes result images and writes them into files in background threads, so matching can continue meanwhile.
+        Pending images are written before the program exits, flush() waits for them explicitly
+
+        :param threads: Number of threads encoding and writing images
+        :param queueSize: Maximum number of images waiting to be written, write() blocks once it's reached
+                          (limits memory held by rendered images)
+        :param jpegQuality: Quality of written JPEG images (0 - 100), OpenCV default if None
+        :param pngCompression: Compression level of written PNG images (0 - 9), OpenCV default if None
+        """
+        self.jpegQuality = jpegQuality
+        self.pngCompression = pngCompression
+        self.queue = queue.Queue(queueSize)
+        # first exception raised in a writing thread, raised again in flush()
+        self.error = None
+        self.closed = False
+        # threads are daemons, so they can't keep the program running - flushing is left to close() called at exit
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(max(1, threads))]
+        for thread in self.threads:
+            thread.start()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def getParams(self, path):
+        """
+        Returns imencode() parameters for the file type of given path
+        """
+        extension = os.path.splitext(path)[1].lower()
+        if extension in (".jpg", ".jpeg") and self.jpegQuality is not None:
+            return [cv.IMWRITE_JPEG_QUALITY, int(self.jpegQuality)]
+        if extension == ".png" and self.pngCompression is not None:
+            return [cv.IMWRITE_PNG_COMPRESSION, int(self.pngCompression)]
+        return []
+
+    def write(self, path, image, diagnostics=None):
+        """
+        Queues an image to be written into a file - the image must not be modified afterwards
+
+        :param path: Path of the file, its extension determines the format
+        :param image: Image to write
+        :param diagnostics: (optional) Diagnostics of an algorithm, encoding time is added to its times.resultEncoding
+        """
+        if self.closed:
+            raise RuntimeError("ResultWriter is already closed")
+        self.queue.put((path, image, diagnostics))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                path, image, diagnostics = item
+                encodingTime = writeImage(path, image, self.getParams(path))
+                if diagnostics is not None:
+                    diagnostics.times.resultEncoding.append(encodingTime)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """
+        Waits until all queued images are written, raises the first error that occurred while writing them
+        """
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        """
+        Writes all queued images and stops the threads, called automatically at exit
+        """
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.flush()
+
+def writeImage(path, image, params=()):
+    """
+    Encodes an image and writes it into a file, creating its directory if needed
+
+    :return: Time it took to encode the image (without writing it)
+    """
+    encodingTime = timer()
+    success, data = cv.imencode(os.path.splitext(path)[1], image, list(params))
+    encodingTime = timer() - encodingTime
+    if not success:
+        raise IOError(f"Couldn't encode image {path}")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "wb") as file:
+        data.tofile(file)
+    return encodingTime
@@ -3,14 +3,27 @@ from src.algorithms.BaseKeypointAlgorithm import BaseKeypointAlgorithm
 from timeit import default_timer as timer
 
 class SURF(BaseKeypointAlgorithm):
-    def __init__(self, parts, images, topMatches=20, drawMatches=True, iteration=None):
-        super().__init__(parts, images, topMatches, drawMatches, iteration)
-        self.bf = cv.BFMatcher(cv.NORM_L2, crossCheck=True)
+    def __init__(self, parts, images, topMatches=20, drawMatches=True, iteration=None, workers=1, threads=1, descriptorCache=None,
+                 indexedMatching=False, indexNeighbours=10, prefilterImages=None, vocabularySize=500, popcountMatching=False,
+                 stackedMatching=False, acceptDistance=None, acceptRatio=None, partKeypointBudget=None,
+                 imageKeypointBudget=None, keypointGrid=None, lazyImages=False):
+        super().__init__(parts, images, topMatches, drawMatches, iteration, workers, threads, descriptorCache,
+                         indexedMatching, indexNeighbours, prefilterImages, vocabularySize, popcountMatching, stackedMatching,
+                         acceptDistance, acceptRatio, partKeypointBudget, imageKeypointBudget, keypointGrid, lazyImages)
+        self.normType = cv.NORM_L2
+        self.bf = cv.BFMatcher(self.normType, crossCheck=True)
+        self.createDetectors()
+
+    def createDetectors(self):
         self.surf = cv.xfeatures2d.SURF_create()
 
-    def calculateDescriptor(self, img):
+    def calculateDescriptor(self, img, budget=None):
         t = timer()
-        keypoints, descriptors = self.surf.detectAndCompute(img, None)
+        if budget is None:
+            keypoints, descriptors = self.surf.detectAndCompute(img, None)
+        else:
+            keypoints = self.retainKeypoints(self.surf.detect(img, None), img.shape, budget)
+            keypoints, descriptors = self.surf.compute(img, keypoints)
         t = timer() - t
 
         return keypoints, descriptors, t
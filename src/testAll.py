@@ -1,7 +1,8 @@
 import gc
+import os
 from time import strftime
 from collections import namedtuple
-from src.algorithms.BaseAlgorithm import fromDirectory
+from src.algorithms.BaseAlgorithm import packDirectory, isArchiveCurrent, fromArchive
 from src.algorithms.HOG import HOG
 from src.algorithms.FT import FT
 from src.algorithms.SIFT import SIFT
@@ -16,6 +17,9 @@ dataDir = "../data"
 partsDir = f"{dataDir}/parts/{size}"
 originalDir = f"{dataDir}/original/{size}"
 outputDir = f"{dataDir}/experimentResults/{size}"
+# decoded images, packed once so iterations don't have to decode them again (packed again when the dataset changes)
+partsArchive = f"{dataDir}/packed/parts_{size}.bin"
+originalArchive = f"{dataDir}/packed/original_{size}.bin"
 
 Algorithm = namedtuple("Algorithm", "name type output")
 
@@ -31,11 +35,16 @@ algorithms = [
 
 print(f"({strftime('%H:%M:%S')}) Started")
 
+for directory, archive in ((partsDir, partsArchive), (originalDir, originalArchive)):
+    if not isArchiveCurrent(archive, directory):
+        os.makedirs(os.path.dirname(archive), exist_ok=True)
+        packDirectory(directory, archive)
+
 for a in algorithms:
     print(f"({strftime('%H:%M:%S')}) Algorithm: {a.name}")
     for i in range(10):
         print(f"({strftime('%H:%M:%S')}) - Iteration {i + 1}")
-        obj = a.type(parts=fromDirectory(partsDir), images=fromDirectory(originalDir), iteration=i)
+        obj = a.type(parts=fromArchive(partsArchive), images=fromArchive(originalArchive), iteration=i)
         obj.process()
         obj.writeResults(f"{a.output}/{i}", includePart=True)
         obj.printResults(f"{a.output}/{i}_result.txt")
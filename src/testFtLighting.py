@@ -9,6 +9,7 @@ from collections import namedtuple
 from src.algorithms.BaseAlgorithm import InputImage
 from src.algorithms.BaseAlgorithm import fromDirectory
 from src.algorithms.FT import FT
+from src.algorithms.ResultWriter import ResultWriter
 
 dataDir = "../data"
 partsDir = f"{dataDir}/parts/300x300"
@@ -39,6 +40,9 @@ countDict = { b: {c: 0 for c in range(-80, 81, step)} for b in range(-80, 81, st
 
 formatProgress = lambda x: f"{(100 * x / total):.0f} %"
 
+# result images are encoded and written in the background while the next combination is being matched
+writer = ResultWriter(threads=2)
+
 for b in range(-80, 81, step):
     for c in range(-80, 81, step):
         progress += 1
@@ -72,10 +76,11 @@ for b in range(-80, 81, step):
                     _path = f"{outputDir}/notSure/{formatFileName(i, b, c)}"
                 else:
                     _path = f"{outputDir}/nope/{formatFileName(i, b, c)}"
-            ft.writeSingleResult(result, _path, includePart=True)
+            ft.writeSingleResult(result, _path, includePart=True, writer=writer)
 
         gc.collect()
 
+writer.close()
 print(f"({strftime('%H:%M:%S')}) Ended")
 # generates a json file with the dictionary
 # this needs to be manually checked and results from notSure folder that are correct have to be added into the result.json